@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -----------------------
+# Name: cache_snapshot.py    Export and import snapshots of the request cache
+# Python Library
+# -----------------------
+
+from optparse import OptionParser
+from tmdb3.cache import Cache
+
+import sys
+
+if __name__ == '__main__':
+    parser = OptionParser(
+        usage="%prog [options] export|import SNAPSHOT",
+        description="Export the live entries of a request cache to a "
+                    "snapshot file, or import a snapshot into a cache, "
+                    "allowing new deployments to start with a warm cache.")
+    parser.add_option('-e', "--engine", default="file", dest="engine",
+                      type="choice", choices=["file", "sqlite"],
+                      help="Cache engine to use, file or sqlite. "
+                           "[default: %default]")
+    parser.add_option('-f', "--filename", default="pytmdb3.cache",
+                      dest="filename",
+                      help="Cache file to use. [default: %default]")
+    opts, args = parser.parse_args()
+
+    if (len(args) != 2) or (args[0] not in ('export', 'import')):
+        parser.error("expected an action and a snapshot filename")
+    action, snapshot = args
+
+    cache = Cache(opts.engine, filename=opts.filename)
+    if action == 'export':
+        count = cache.dump(snapshot)
+        print("Exported {0} entries to {1}".format(count, snapshot))
+    else:
+        count = cache.restore(snapshot)
+        print("Imported {0} entries from {1}".format(count, snapshot))
+    sys.exit(0)
@@ -6,19 +6,43 @@
 # (http://creativecommons.org/licenses/GPL/2.0/)
 # ----------------------------------------------
 
-from os.path import join, dirname, isfile
+from os.path import join, dirname, isfile, getsize
 from os import remove
-from httpretty import httprettified
+import os
+import multiprocessing
+import struct
+import socket
+import json
+import threading
+import gzip
+import zlib
+import time
+import http.client
+import urllib.error
+import urllib.request
+from unittest import TestCase
+from unittest.mock import patch
+import httpretty
+from httpretty import httprettified, HTTPretty
 
-from tests import AbstractTestTmdbCase
+from tests import AbstractTestTmdbCase, FAKE_API_KEY
 from tests.test_movies_api import test_movie_data
 
 from tmdb3 import locales as tmdb3_locales
-from tmdb3 import searchMovie
-from tmdb3.tmdb_exceptions import TMDBCacheError
+from tmdb3 import searchMovie, set_key, set_cache, set_lifetime
+from tmdb3 import set_rate_limit
+from tmdb3 import request
+from tmdb3.request import Request
+from tmdb3.tmdb_exceptions import TMDBCacheError, TMDBRequestError
+from tmdb3.tmdb_exceptions import TMDBKeyInvalid, TMDBRequestInvalid
 from tmdb3.tmdb_api import MovieSearchResult
 from tmdb3.cache import Cache
-from tmdb3.cache_file import FileEngine
+from tmdb3.cache_file import FileEngine, Flock
+from tmdb3.cache_sqlite import SQLiteEngine
+from tmdb3.cache_memory import MemoryEngine
+from tmdb3.cache_stats import endpoint
+from tmdb3.rate_limit import RateLimiter, SharedRateLimiter
+from tmdb3.http_pool import ConnectionPool
 
 tmdb3_locales.set_locale("en", "us", True)
 tmdb3_locales.syslocale.encoding = 'utf-8'
@@ -36,8 +60,9 @@ class TestCache(AbstractTestTmdbCase):
     cache_file = CACHE_FILE
 
     def tearDown(self):
-        if isfile(self.cache_file):
-            remove(self.cache_file)
+        for suffix in ('', '.bloom', '.flight'):
+            if isfile(self.cache_file + suffix):
+                remove(self.cache_file + suffix)
 
     def test_cache_configure(self):
         cache = Cache(filename=self.cache_file)
@@ -55,3 +80,1130 @@ class TestCache(AbstractTestTmdbCase):
         # Here we test the reading of the cache file by requesting some info
         movie = [i for i in result if i.title == 'Star Wars'][0]
         self.assertEqual(movie.imdb, 'tt0076759')
+
+
+UNPICKLED = []
+
+
+def unpickled():
+    UNPICKLED.append(1)
+
+
+class Unpickled(object):
+    # records being loaded from a pickle
+    def __reduce__(self):
+        return (unpickled, ())
+
+
+class TestFileEngine(TestCase):
+    cache_file = CACHE_FILE
+
+    def tearDown(self):
+        for suffix in ('', '.lock', '.bloom', '.flight'):
+            if isfile(self.cache_file + suffix):
+                remove(self.cache_file + suffix)
+
+    def test_lookup_after_rewrite(self):
+        cache = Cache(filename=self.cache_file, preallocate=4)
+        for i in range(20):
+            cache.put('movie/{0}'.format(i), {'id': i}, 60)
+        # entries are looked up from the file rather than held in memory
+        self.assertEqual(cache._data, {})
+        other = Cache(filename=self.cache_file)
+        for i in range(20):
+            self.assertEqual(other.get('movie/{0}'.format(i)), {'id': i})
+        self.assertIsNone(other.get('movie/20'))
+
+    def test_replace_and_expire(self):
+        cache = Cache(filename=self.cache_file)
+        cache.put('movie/11', {'title': 'Star Wars'}, 60)
+        cache.put('movie/11', {'title': 'A New Hope'}, 60)
+        self.assertEqual(cache.get('movie/11'), {'title': 'A New Hope'})
+        cache._engine.expire('movie/11')
+        self.assertIsNone(cache.get('movie/11'))
+
+    def test_compact(self):
+        cache = Cache(filename=self.cache_file, compact_ratio=0)
+        for i in range(20):
+            cache.put('movie/{0}'.format(i % 5), {'id': i}, 60)
+        cache.put('movie/5', {'id': 5}, 0)
+        engine = cache._engine
+        self.assertGreater(engine.dead_ratio(), 0.5)
+        size = getsize(self.cache_file)
+        self.assertTrue(engine.compact())
+        self.assertEqual(engine.dead_ratio(), 0)
+        self.assertLess(getsize(self.cache_file), size)
+        for i in range(15, 20):
+            self.assertEqual(cache.get('movie/{0}'.format(i % 5)), {'id': i})
+        self.assertIsNone(cache.get('movie/5'))
+
+    def test_free_slots_grow(self):
+        cache = Cache(filename=self.cache_file, preallocate=4)
+        engine = cache._engine
+        with patch.object(engine, 'compact', wraps=engine.compact) as compact:
+            for i in range(100):
+                cache.put('movie/{0}'.format(i), {'id': i}, 60)
+        # rather than once every 4 entries
+        self.assertLessEqual(compact.call_count, 8)
+        self.assertGreaterEqual(engine.size - engine.used, engine.used // 3)
+
+    def test_mmap_reads(self):
+        cache = Cache(filename=self.cache_file, preallocate=4, use_mmap=True)
+        other = Cache(filename=self.cache_file, use_mmap=True)
+        for i in range(20):
+            cache.put('movie/{0}'.format(i), {'id': i}, 60)
+            # the other cache follows the file as it grows and is rewritten
+            self.assertEqual(other.get('movie/{0}'.format(i)), {'id': i})
+        self.assertTrue(other._engine.compact())
+        self.assertEqual(cache.get('movie/0'), {'id': 0})
+
+    def test_mmap_compacted_elsewhere(self):
+        cache = Cache(filename=self.cache_file, use_mmap=True)
+        other = Cache(filename=self.cache_file, use_mmap=True, compact_ratio=0)
+        for i in range(10):
+            other.put('movie/{0}'.format(i), {'pad': 'x' * 1000}, 60)
+        for i in range(10):
+            other.put('movie/{0}'.format(i), {'id': i}, 60)
+        self.assertEqual(cache.get('movie/0'), {'id': 0})
+        size = getsize(self.cache_file)
+        self.assertTrue(other._engine.compact())
+        # grow the new file back to the size of the mapping
+        pad = size - getsize(self.cache_file)
+        pad -= len(json.dumps(['movie/pad', {'pad': ''}]))
+        other.put('movie/pad', {'pad': 'x' * pad}, 60)
+        self.assertEqual(getsize(self.cache_file), size)
+        self.assertEqual(cache.get('movie/pad'), {'pad': 'x' * pad})
+        cache.put('movie/20', {'id': 20}, 60)
+        self.assertEqual(other.get('movie/pad'), {'pad': 'x' * pad})
+        self.assertEqual(other.get('movie/20'), {'id': 20})
+
+    def test_compressed_blocks(self):
+        overview = {'overview': 'A long time ago in a galaxy far away. ' * 20}
+        cache = Cache(filename=self.cache_file, compress=True)
+        cache.put('movie/12', {'title': 'Finding Nemo'}, 60)
+        size = getsize(self.cache_file)
+        cache.put('movie/11', overview, 60)
+        self.assertLess(getsize(self.cache_file) - size, 200)
+        # compressed and plain blocks are read back alike
+        other = Cache(filename=self.cache_file)
+        self.assertEqual(other.get('movie/11'), overview)
+        self.assertEqual(other.get('movie/12'), {'title': 'Finding Nemo'})
+
+    def test_serializers(self):
+        credits = {'cast': [{'name': 'Mark Hamill', 'order': 0}]}
+        for serializer in ('json', 'marshal', 'pickle'):
+            cache = Cache(filename=self.cache_file, serializer=serializer)
+            cache.put(serializer, credits, 60)
+        # blocks record their serializer, and are read with it if it is
+        # JSON or the one the reader is using
+        other = Cache(filename=self.cache_file, serializer='marshal')
+        self.assertEqual(other.get('json'), credits)
+        self.assertEqual(other.get('marshal'), credits)
+        self.assertIsNone(other.get('pickle'))
+        self.assertRaises(
+            TMDBCacheError, Cache, filename=self.cache_file, serializer='xml'
+        )
+
+    def test_untrusted_serializer(self):
+        # pickled blocks are never loaded by caches not using pickle
+        Cache(filename=self.cache_file, serializer='pickle').put(
+            'movie/11', Unpickled(), 60
+        )
+        other = Cache(filename=self.cache_file)
+        self.assertIsNone(other.get('movie/11'))
+        self.assertEqual(other._engine.dump(), [])
+        self.assertEqual(other._engine.get(0), [])
+        self.assertEqual(UNPICKLED, [])
+        other = Cache(filename=self.cache_file, serializer='pickle')
+        other.get('movie/11')
+        self.assertTrue(UNPICKLED)
+        del UNPICKLED[:]
+
+    def test_shards(self):
+        cache = Cache(filename=self.cache_file, shards=4)
+        for i in range(40):
+            cache.put('movie/{0}'.format(i), {'id': i}, 60)
+        other = Cache(filename=self.cache_file, shards=4)
+        for i in range(40):
+            self.assertEqual(other.get('movie/{0}'.format(i)), {'id': i})
+        self.assertEqual(len(other._engine.get(0)), 40)
+        for i in range(4):
+            shard = '{0}.{1}'.format(self.cache_file, i)
+            self.assertTrue(isfile(shard))
+            remove(shard)
+            remove(shard + '.bloom')
+
+    def test_bloom_filter(self):
+        cache = Cache(filename=self.cache_file, preallocate=4)
+        for i in range(10):
+            cache.put('movie/{0}'.format(i), {'id': i}, 60)
+        self.assertTrue(isfile(self.cache_file + '.bloom'))
+        locks = cache.stats()['timers']['lock_wait']['count']
+        for i in range(10, 20):
+            self.assertIsNone(cache.get('movie/{0}'.format(i)))
+        # misses were answered without locking the cache file
+        stats = cache.stats()
+        self.assertGreaterEqual(stats['counters']['bloom_skips'], 9)
+        self.assertLessEqual(stats['timers']['lock_wait']['count'], locks + 1)
+
+        # compaction rebuilds the filter with the entries kept
+        cache.put('movie/0', {'id': 0}, 0)
+        cache._engine.compact()
+        for i in range(1, 10):
+            self.assertEqual(cache.get('movie/{0}'.format(i)), {'id': i})
+
+    def test_bloom_filter_compact_race(self):
+        # a key written to the new file as soon as it replaces the old one
+        # must stay in the filter
+        cache = Cache(filename=self.cache_file)
+        for i in range(10):
+            cache.put('movie/{0}'.format(i), {'id': i}, 60)
+        replace = os.replace
+
+        def replace_and_put(src, dst):
+            replace(src, dst)
+            Cache(filename=self.cache_file).put('movie/new', {'id': 1}, 60)
+
+        with patch.object(os, 'replace', replace_and_put):
+            self.assertTrue(cache._engine.compact())
+        other = Cache(filename=self.cache_file)
+        self.assertEqual(other.get('movie/new'), {'id': 1})
+        self.assertNotIn('bloom_skips', other.stats()['counters'])
+
+    def test_bloom_filter_created(self):
+        # a filter created beside an existing cache holds its entries
+        cache = Cache(filename=self.cache_file, bloom_bits=0)
+        cache.put('movie/11', {'title': 'Star Wars'}, 60)
+        self.assertFalse(isfile(self.cache_file + '.bloom'))
+        other = Cache(filename=self.cache_file)
+        self.assertEqual(other.get('movie/11'), {'title': 'Star Wars'})
+        self.assertTrue(isfile(self.cache_file + '.bloom'))
+
+    def test_old_version_rewritten(self):
+        with open(self.cache_file, 'wb') as fd:
+            fd.write(struct.pack('HH', 2, 0))
+        cache = Cache(filename=self.cache_file)
+        self.assertIsNone(cache.get('movie/11'))
+        cache.put('movie/11', {'title': 'Star Wars'}, 60)
+        self.assertEqual(cache.get('movie/11'), {'title': 'Star Wars'})
+
+
+class TestSQLiteCache(TestCase):
+    cache_file = join(dirname(__file__), 'tmdb3.sqlite')
+
+    def tearDown(self):
+        for suffix in ('', '-wal', '-shm'):
+            if isfile(self.cache_file + suffix):
+                remove(self.cache_file + suffix)
+
+    def test_cache_configure(self):
+        cache = Cache('sqlite', filename=self.cache_file)
+        self.assertIsInstance(cache._engine, SQLiteEngine)
+
+    def test_read_write_cache(self):
+        cache = Cache('sqlite', filename=self.cache_file)
+        self.assertIsNone(cache.get('movie/11'))
+        cache.put('movie/11', {'title': 'Star Wars'}, 60)
+        self.assertEqual(cache.get('movie/11'), {'title': 'Star Wars'})
+        # entries are shared with any other cache using the same database
+        other = Cache('sqlite', filename=self.cache_file)
+        self.assertEqual(other.get('movie/11'), {'title': 'Star Wars'})
+        # and are looked up from the database rather than held in memory
+        self.assertEqual(other._data, {})
+
+    def test_expired_entry(self):
+        cache = Cache('sqlite', filename=self.cache_file)
+        cache.put('movie/11', {'title': 'Star Wars'}, 0)
+        self.assertIsNone(cache.get('movie/11'))
+
+    def test_fork(self):
+        cache = Cache('sqlite', filename=self.cache_file)
+        cache.put('movie/11', {'title': 'Star Wars'}, 60)
+        conn = cache._engine._conn
+        pid = os.getpid() + 1
+        with patch('tmdb3.cache_sqlite.os.getpid', return_value=pid):
+            cache.put('movie/12', {'title': 'Finding Nemo'}, 60)
+            # the child connects again, leaving the parent's connection open
+            self.assertIsNot(cache._engine._conn, conn)
+            conn.execute("SELECT 1")
+        self.assertEqual(
+            Cache('sqlite', filename=self.cache_file).get('movie/12'),
+            {'title': 'Finding Nemo'},
+        )
+
+
+class TestMemoryCache(TestCase):
+    def test_cache_configure(self):
+        cache = Cache('memory', max_entries=10)
+        self.assertIsInstance(cache._engine, MemoryEngine)
+
+    def test_evict_least_recently_used(self):
+        cache = Cache('memory', max_entries=2)
+        cache.put('movie/11', {'title': 'Star Wars'}, 60)
+        cache.put('movie/12', {'title': 'Finding Nemo'}, 60)
+        # touch the first entry, so the second is the oldest in use
+        self.assertIsNotNone(cache.get('movie/11'))
+        cache.put('movie/13', {'title': 'Forrest Gump'}, 60)
+        self.assertIsNone(cache.get('movie/12'))
+        self.assertIsNotNone(cache.get('movie/11'))
+        self.assertIsNotNone(cache.get('movie/13'))
+        self.assertEqual(cache._data, {})
+
+    def test_evict_by_size(self):
+        cache = Cache('memory', max_bytes=64)
+        cache.put('movie/11', {'overview': 'x' * 40}, 60)
+        cache.put('movie/12', {'overview': 'y' * 40}, 60)
+        self.assertIsNone(cache.get('movie/11'))
+        self.assertIsNotNone(cache.get('movie/12'))
+        self.assertLessEqual(cache._engine.size, 64)
+
+
+class TestTwoTierCache(TestCase):
+    cache_file = join(dirname(__file__), 'tmdb3.sqlite')
+
+    def tearDown(self):
+        for suffix in ('', '-wal', '-shm'):
+            if isfile(self.cache_file + suffix):
+                remove(self.cache_file + suffix)
+
+    def test_read_through(self):
+        # populate the persistent store from another cache
+        Cache('sqlite', filename=self.cache_file).put(
+            'movie/11', {'title': 'Star Wars'}, 60
+        )
+        cache = Cache('sqlite', filename=self.cache_file, hot_entries=2)
+        self.assertEqual(cache.get('movie/11'), {'title': 'Star Wars'})
+        self.assertEqual(cache.get('movie/11'), {'title': 'Star Wars'})
+        self.assertIsNone(cache.get('movie/12'))
+        self.assertEqual(cache.hits, {'hot': 1, 'engine': 1, 'stale': 0})
+        self.assertEqual(cache.misses, 1)
+
+    def test_write_through(self):
+        cache = Cache('sqlite', filename=self.cache_file, hot_entries=2)
+        cache.put('movie/11', {'title': 'Star Wars'}, 60)
+        self.assertEqual(cache.get('movie/11'), {'title': 'Star Wars'})
+        self.assertEqual(cache.hits, {'hot': 1, 'engine': 0, 'stale': 0})
+        other = Cache('sqlite', filename=self.cache_file)
+        self.assertEqual(other.get('movie/11'), {'title': 'Star Wars'})
+
+
+class TestStaleWhileRevalidate(TestCase):
+    def test_serve_stale_and_refresh(self):
+        cache = Cache('memory', stale=60)
+
+        class Source(object):
+            lifetime = 60
+            value = 'fresh'
+
+            def key(self):
+                return 'movie/11'
+
+            @cache.cached(key)
+            def read(self):
+                return self.value
+
+        # an entry which has just expired
+        cache.put('movie/11', 'stale', 0)
+        self.assertEqual(Source().read(), 'stale')
+        self.assertEqual(cache.hits['stale'], 1)
+        for i in range(100):
+            if cache.get('movie/11') == 'fresh':
+                break
+            time.sleep(0.01)
+        self.assertEqual(Source().read(), 'fresh')
+
+    def test_stale_disabled(self):
+        cache = Cache('memory')
+        cache.put('movie/11', 'stale', 0)
+        self.assertIsNone(cache.get('movie/11', lambda: None))
+
+
+@httprettified
+class TestNegativeCache(TestCase):
+    def setUp(self):
+        set_key(FAKE_API_KEY)
+        set_cache('memory')
+
+    def tearDown(self):
+        set_cache('null')
+
+    def test_invalid_id_cached(self):
+        HTTPretty.register_uri(
+            HTTPretty.GET,
+            'http://api.themoviedb.org/3/movie/0?api_key=' + FAKE_API_KEY,
+            status=404,
+            body='{"status_code": 34, "status_message": "Not found."}',
+        )
+        for i in range(3):
+            with self.assertRaises(TMDBRequestInvalid) as cm:
+                Request('movie/0').readJSON()
+            self.assertEqual(cm.exception.tmdberrno, 34)
+        # only the first attempt reached the network
+        self.assertEqual(len(httpretty.latest_requests()), 1)
+        self.assertEqual(
+            request.cache._engine.lookup(
+                Request('movie/0').cache_key()
+            ).lifetime,
+            Request.negative_lifetime,
+        )
+
+
+class TestCacheKey(TestCase):
+    def setUp(self):
+        set_key(FAKE_API_KEY)
+
+    def tearDown(self):
+        Request._api_key = FAKE_API_KEY
+
+    def test_parameter_order(self):
+        self.assertEqual(
+            Request('search/movie', query='Star Wars', page=2).cache_key(),
+            Request('search/movie', page=2, query='Star Wars').cache_key(),
+        )
+        self.assertEqual(
+            Request('search/movie', page=2, query='Star Wars').cache_key(),
+            'search/movie?page=2&query=Star+Wars',
+        )
+
+    def test_api_key(self):
+        key = Request('movie/11').cache_key()
+        self.assertEqual(key, 'movie/11')
+        set_key('f' * 32)
+        self.assertEqual(Request('movie/11').cache_key(), key)
+
+    def test_session_id(self):
+        key = Request('account', session_id='abc').cache_key()
+        self.assertNotIn('abc', key)
+        self.assertNotEqual(
+            key, Request('account', session_id='abd').cache_key()
+        )
+
+
+class TestLifetimes(TestCase):
+    def setUp(self):
+        set_key(FAKE_API_KEY)
+        self.lifetimes = list(request.lifetimes)
+
+    def tearDown(self):
+        request.lifetimes[:] = self.lifetimes
+
+    def test_lifetime_policy(self):
+        self.assertEqual(Request('configuration').lifetime, 60 * 60 * 24 * 7)
+        self.assertEqual(Request('search/movie').lifetime, 60 * 15)
+        self.assertEqual(Request('movie/11').lifetime, 60 * 60 * 12)
+        self.assertEqual(Request('movie/popular').lifetime, 60 * 60)
+        self.assertEqual(Request('movie/11/images').lifetime, 60 * 60)
+
+    def test_set_lifetime(self):
+        set_lifetime('movie/{id}/images', 60 * 60 * 24)
+        set_lifetime('search/*', 60)
+        self.assertEqual(Request('movie/11/images').lifetime, 60 * 60 * 24)
+        self.assertEqual(Request('search/movie').lifetime, 60)
+        self.assertEqual(Request('movie/11').lifetime, 60 * 60 * 12)
+
+
+class TestSnapshot(TestCase):
+    snapshot = join(dirname(__file__), 'tmdb3.snapshot')
+    sqlite_file = join(dirname(__file__), 'tmdb3.sqlite')
+
+    def tearDown(self):
+        for filename in (
+            self.snapshot,
+            CACHE_FILE,
+            CACHE_FILE + '.lock',
+            CACHE_FILE + '.bloom',
+            CACHE_FILE + '.flight',
+            self.sqlite_file,
+            self.sqlite_file + '-wal',
+            self.sqlite_file + '-shm',
+        ):
+            if isfile(filename):
+                remove(filename)
+
+    def test_dump_and_restore(self):
+        cache = Cache(filename=CACHE_FILE)
+        for i in range(10):
+            cache.put('movie/{0}'.format(i), {'id': i}, 60)
+        cache.put('movie/10', {'id': 10}, 0)
+        self.assertEqual(cache.dump(self.snapshot), 10)
+
+        for engine in ('sqlite', 'memory'):
+            if engine == 'sqlite':
+                other = Cache(engine, filename=self.sqlite_file)
+            else:
+                other = Cache(engine)
+            other.put('movie/0', {'id': 'newer'}, 60)
+            self.assertEqual(other.restore(self.snapshot), 10)
+            for i in range(1, 10):
+                self.assertEqual(other.get('movie/{0}'.format(i)), {'id': i})
+            # entries cached later than the snapshot are kept
+            self.assertEqual(other.get('movie/0'), {'id': 'newer'})
+            self.assertIsNone(other.get('movie/10'))
+
+    def test_restore_file(self):
+        cache = Cache('memory')
+        cache.put('movie/11', {'title': 'Star Wars'}, 60)
+        cache.dump(self.snapshot)
+        other = Cache(filename=CACHE_FILE, shards=2)
+        other.restore(self.snapshot)
+        self.assertEqual(other.get('movie/11'), {'title': 'Star Wars'})
+        for i in range(2):
+            remove('{0}.{1}'.format(CACHE_FILE, i))
+            remove('{0}.{1}.bloom'.format(CACHE_FILE, i))
+
+    def test_invalid_snapshot(self):
+        with open(self.snapshot, 'w') as fd:
+            fd.write('not a snapshot')
+        self.assertRaises(
+            TMDBCacheError, Cache('memory').restore, self.snapshot
+        )
+
+
+class TestCacheStats(TestCase):
+    cache_file = CACHE_FILE
+
+    def tearDown(self):
+        for suffix in ('', '.lock', '.bloom', '.flight'):
+            if isfile(self.cache_file + suffix):
+                remove(self.cache_file + suffix)
+
+    def test_endpoint(self):
+        self.assertEqual(
+            endpoint('https://api.themoviedb.org/3/movie/11/images'
+                     '?api_key=xxx&language=en'),
+            'movie/{id}/images',
+        )
+        self.assertEqual(endpoint('search/movie'), 'search/movie')
+
+    def test_stats(self):
+        cache = Cache(filename=self.cache_file)
+        cache.put('movie/11', {'title': 'Star Wars'}, 60)
+        self.assertEqual(cache.get('movie/11'), {'title': 'Star Wars'})
+        self.assertIsNone(cache.get('movie/12'))
+        stats = cache.stats()
+        self.assertEqual(
+            stats['endpoints'], {'movie/{id}': {'hits': 1, 'misses': 1}}
+        )
+        self.assertEqual(stats['hits']['engine'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertGreater(stats['counters']['bytes_written'], 0)
+        self.assertEqual(
+            stats['counters']['bytes_read'],
+            stats['counters']['bytes_written'],
+        )
+        self.assertEqual(stats['timers']['get']['count'], 2)
+        self.assertEqual(stats['timers']['put']['count'], 1)
+        self.assertGreaterEqual(stats['timers']['lock_wait']['count'], 3)
+
+        cache.stats(reset=True)
+        stats = cache.stats()
+        self.assertEqual(stats['endpoints'], {})
+        self.assertEqual(stats['misses'], 0)
+
+    def test_compaction_bytes(self):
+        cache = Cache(filename=self.cache_file, compact_ratio=0)
+        for i in range(10):
+            cache.put('movie/{0}'.format(i), {'id': i}, 60)
+        for i in range(5):
+            cache.put('movie/{0}'.format(i), {'id': i + 10}, 60)
+        written = cache.stats()['counters']['bytes_written']
+        self.assertTrue(cache._engine.compact())
+        # the 10 live entries were copied to the new file
+        live = [
+            ['movie/{0}'.format(i), {'id': i + 10 if i < 5 else i}]
+            for i in range(10)
+        ]
+        self.assertEqual(
+            cache.stats()['counters']['bytes_written'] - written,
+            sum(len(json.dumps(entry)) for entry in live),
+        )
+
+    def test_report(self):
+        reports = []
+        cache = Cache('memory')
+        cache.report(reports.append, 0)
+        cache.put('movie/11', {'title': 'Star Wars'}, 60)
+        cache.get('movie/11')
+        self.assertEqual(len(reports), 2)
+        self.assertEqual(reports[-1]['hits']['engine'], 1)
+        cache.report(None)
+        cache.get('movie/11')
+        self.assertEqual(len(reports), 2)
+
+
+class TestBatch(TestCase):
+    cache_file = CACHE_FILE
+
+    def tearDown(self):
+        for suffix in ('', '.lock', '.bloom', '.sqlite', '.sqlite-wal',
+                       '.sqlite-shm'):
+            if isfile(self.cache_file + suffix):
+                remove(self.cache_file + suffix)
+
+    def test_batch(self):
+        cache = Cache(filename=self.cache_file, preallocate=4)
+        cache.put('movie/0', {'id': 0}, 60)
+        locks = cache.stats()['timers']['lock_wait']['count']
+        with cache.batch():
+            for i in range(1, 20):
+                cache.put('movie/{0}'.format(i), {'id': i}, 60)
+                with cache.batch():
+                    cache.put('movie/{0}/images'.format(i), {'id': i}, 60)
+            # held back from the file, but returned to this thread
+            self.assertEqual(cache.get('movie/5'), {'id': 5})
+            self.assertIsNone(
+                Cache(filename=self.cache_file).get('movie/5')
+            )
+            self.assertEqual(
+                cache.stats()['timers']['lock_wait']['count'], locks
+            )
+        other = Cache(filename=self.cache_file)
+        for i in range(1, 20):
+            self.assertEqual(other.get('movie/{0}'.format(i)), {'id': i})
+            self.assertEqual(
+                other.get('movie/{0}/images'.format(i)), {'id': i}
+            )
+        self.assertEqual(other.get('movie/0'), {'id': 0})
+        self.assertEqual(len(other._engine.dump()), 39)
+
+    def test_batch_error(self):
+        cache = Cache('sqlite', filename=self.cache_file + '.sqlite')
+        with self.assertRaises(ValueError):
+            with cache.batch():
+                cache.put('movie/11', {'title': 'Star Wars'}, 60)
+                raise ValueError
+        # responses already fetched are kept
+        self.assertEqual(cache.get('movie/11'), {'title': 'Star Wars'})
+
+    def test_put_many_shards(self):
+        cache = Cache(filename=self.cache_file, shards=2)
+        with cache.batch():
+            for i in range(10):
+                cache.put('movie/{0}'.format(i), {'id': i}, 60)
+        other = Cache(filename=self.cache_file, shards=2)
+        for i in range(10):
+            self.assertEqual(other.get('movie/{0}'.format(i)), {'id': i})
+        for i in range(2):
+            for suffix in ('', '.bloom'):
+                remove('{0}.{1}{2}'.format(self.cache_file, i, suffix))
+
+
+class TestWriteBehind(TestCase):
+    cache_file = CACHE_FILE
+
+    def tearDown(self):
+        for suffix in ('', '.lock', '.bloom'):
+            if isfile(self.cache_file + suffix):
+                remove(self.cache_file + suffix)
+
+    def test_write_behind(self):
+        cache = Cache(filename=self.cache_file, write_behind=True)
+        for i in range(20):
+            cache.put('movie/{0}'.format(i), {'id': i}, 60)
+            cache.put('movie/11', {'title': 'Star Wars'}, 60)
+        # queued data is returned before it is written out
+        self.assertEqual(cache.get('movie/11'), {'title': 'Star Wars'})
+        cache.flush()
+        self.assertEqual(cache._queued, {})
+        other = Cache(filename=self.cache_file)
+        self.assertEqual(other.get('movie/11'), {'title': 'Star Wars'})
+        for i in range(20):
+            if i != 11:
+                self.assertEqual(other.get('movie/{0}'.format(i)), {'id': i})
+        # repeated puts of a key were coalesced
+        self.assertLessEqual(cache.stats()['timers']['put']['count'], 20)
+
+    def test_write_errors(self):
+        cache = Cache('memory', write_behind=True)
+
+        def put_many(objects):
+            raise TMDBCacheError('Disk full')
+
+        cache._engine.put_many = put_many
+        cache.put('movie/11', {'title': 'Star Wars'}, 60)
+        cache.flush()
+        self.assertEqual(cache.stats()['counters']['write_errors'], 1)
+        self.assertIsNone(cache.get('movie/11'))
+
+
+def hold_claim(filename, key, claimed):
+    # fetch a key in another process, storing it after a while
+    cache = Cache(filename=filename)
+    with cache._engine.claim(key):
+        claimed.set()
+        time.sleep(0.5)
+        cache.put(key, {'title': 'Star Wars'}, 60)
+
+
+def fetch_held_back(filename, key, claimed, mode):
+    # fetch a key in another process, holding back the write to the cache
+    # file with a batch or write_behind
+    cache = Cache(filename=filename, write_behind=(mode == 'write_behind'))
+    # never write out the queue in the background
+    cache._start_writer = lambda: None
+
+    def fetch():
+        claimed.set()
+        time.sleep(0.5)
+        cache.put(key, {'title': 'Star Wars'}, 60)
+        return {'title': 'Star Wars'}
+
+    with cache.batch():
+        cache._flight(key, fetch)
+        time.sleep(1)
+
+
+class TestSingleFlight(TestCase):
+    def _fetcher(self, cache, fetch):
+        class Fetcher(object):
+            lifetime = 60
+
+            def key(self):
+                return 'movie/11'
+
+            @cache.cached(key)
+            def read(self):
+                return fetch()
+
+        return Fetcher()
+
+    def _run(self, func, count=5):
+        results = []
+
+        def run():
+            try:
+                results.append(func())
+            except Exception as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=run) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_misses(self):
+        cache = Cache('memory')
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            time.sleep(0.2)
+            return {'title': 'Star Wars'}
+
+        results = self._run(self._fetcher(cache, fetch).read)
+        self.assertEqual(results, [{'title': 'Star Wars'}] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.stats()['counters']['coalesced'], 4)
+
+    def test_concurrent_errors(self):
+        cache = Cache('memory')
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            time.sleep(0.2)
+            raise TMDBRequestInvalid('Invalid id')
+
+        results = self._run(self._fetcher(cache, fetch).read)
+        self.assertEqual(len(calls), 1)
+        for result in results:
+            self.assertIsInstance(result, TMDBRequestInvalid)
+        # errors are not cached, the next call is made again
+        self.assertRaises(
+            TMDBRequestInvalid, self._fetcher(cache, fetch).read
+        )
+        self.assertEqual(len(calls), 2)
+
+    def test_other_process(self):
+        cache = Cache(filename=CACHE_FILE)
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            return {'title': 'Star Wars'}
+
+        context = multiprocessing.get_context('fork')
+        claimed = context.Event()
+        process = context.Process(
+            target=hold_claim, args=(CACHE_FILE, 'movie/11', claimed)
+        )
+        process.start()
+        try:
+            claimed.wait(5)
+            data = self._fetcher(cache, fetch).read()
+        finally:
+            process.join()
+            for suffix in ('', '.bloom', '.flight'):
+                remove(CACHE_FILE + suffix)
+        self.assertEqual(data, {'title': 'Star Wars'})
+        # the response stored by the other process was used
+        self.assertEqual(calls, [])
+        self.assertEqual(cache.stats()['timers']['flight_wait']['count'], 1)
+
+    def test_other_process_held_back(self):
+        for mode in ('batch', 'write_behind'):
+            cache = Cache(filename=CACHE_FILE)
+            calls = []
+
+            def fetch():
+                calls.append(1)
+                return {'title': 'Star Wars'}
+
+            context = multiprocessing.get_context('fork')
+            claimed = context.Event()
+            process = context.Process(
+                target=fetch_held_back,
+                args=(CACHE_FILE, 'movie/11', claimed, mode),
+            )
+            process.start()
+            try:
+                claimed.wait(5)
+                data = self._fetcher(cache, fetch).read()
+            finally:
+                process.join()
+                for suffix in ('', '.bloom', '.flight'):
+                    remove(CACHE_FILE + suffix)
+            self.assertEqual(data, {'title': 'Star Wars'})
+            # written out before the claim was released
+            self.assertEqual(calls, [], mode)
+
+
+def timed_acquire(limiter, waited):
+    start = time.time()
+    limiter.acquire()
+    waited.value = time.time() - start
+
+
+class TestRateLimiter(TestCase):
+    def setUp(self):
+        self.limiter = request.limiter
+        # start each test with an empty window
+        set_rate_limit(3, 30)
+
+    def tearDown(self):
+        request.limiter = self.limiter
+
+    def test_burst(self):
+        limiter = RateLimiter(rate=20, burst=3)
+        self.assertEqual([limiter.acquire() for i in range(3)], [0, 0, 0])
+        start = time.time()
+        self.assertGreater(limiter.acquire(), 0)
+        # sent once the window of 3 / 20 seconds of the first one passed
+        self.assertGreaterEqual(time.time() - start, 0.14)
+
+    def test_shared(self):
+        filename = join(dirname(__file__), 'tmdb3.ratelimit')
+        try:
+            first = SharedRateLimiter(filename, rate=20, burst=2)
+            second = SharedRateLimiter(filename, rate=20, burst=2)
+            self.assertEqual(first.acquire(), 0)
+            self.assertEqual(second.acquire(), 0)
+            # the window was used up by both limiters together
+            self.assertGreater(first.acquire(), 0.05)
+        finally:
+            remove(filename)
+
+    def test_default_window(self):
+        # the default keeps within 30 requests in any 10 seconds
+        clock = [1000.0]
+
+        def sleep(seconds):
+            clock[0] += seconds
+
+        sent = []
+        with patch('tmdb3.rate_limit.time') as fake:
+            fake.monotonic.side_effect = lambda: clock[0]
+            fake.sleep.side_effect = sleep
+            limiter = RateLimiter()
+            for i in range(100):
+                limiter.acquire()
+                sent.append(clock[0])
+        for start in sent:
+            window = [t for t in sent if start <= t < start + 10]
+            self.assertLessEqual(len(window), 30)
+        # while sending the full 30 in every 10 seconds
+        self.assertLessEqual(sent[-1] - sent[0], 30)
+
+    def test_shared_fork(self):
+        # a forked process opens the file again, and is held back by the
+        # lock of its parent
+        filename = join(dirname(__file__), 'tmdb3.ratelimit')
+        limiter = SharedRateLimiter(filename, rate=20, burst=10)
+        limiter.acquire()
+        context = multiprocessing.get_context('fork')
+        waited = context.Value('d', 0)
+        try:
+            with Flock(limiter._fd, Flock.LOCK_EX):
+                process = context.Process(
+                    target=timed_acquire, args=(limiter, waited)
+                )
+                process.start()
+                time.sleep(0.3)
+            process.join()
+            self.assertGreaterEqual(waited.value, 0.2)
+        finally:
+            remove(filename)
+
+    def test_disabled(self):
+        limiter = RateLimiter(rate=0, burst=0)
+        self.assertEqual([limiter.acquire() for i in range(100)], [0] * 100)
+
+    @httprettified
+    def test_requests_limited(self):
+        # requests are limited even with caching disabled
+        set_key(FAKE_API_KEY)
+        set_cache('null')
+        set_rate_limit(20, 1)
+        HTTPretty.register_uri(
+            HTTPretty.GET,
+            'http://api.themoviedb.org/3/movie/11',
+            body='{"title": "Star Wars"}',
+        )
+        start = time.time()
+        for i in range(3):
+            Request('movie/11').readJSON()
+        self.assertGreaterEqual(time.time() - start, 0.09)
+
+    def test_sync(self):
+        limiter = RateLimiter(rate=1, burst=40)
+        for i in range(40):
+            limiter.acquire()
+        # the server allows more than the limiter would
+        limiter.sync(10)
+        self.assertEqual(limiter.acquire(), 0)
+        limiter.sync(0, time.time() + 0.1)
+        self.assertGreater(limiter.acquire(), 0.05)
+
+        # reservations of callers still waiting are kept
+        limiter = RateLimiter(rate=10, burst=5)
+        for i in range(8):
+            limiter._update(limiter._reserve)
+        limiter.sync(10)
+        self.assertGreater(limiter._update(limiter._reserve), 0.4)
+
+    @httprettified
+    def test_retry_after(self):
+        set_key(FAKE_API_KEY)
+        set_cache('null')
+        HTTPretty.register_uri(
+            HTTPretty.GET,
+            'http://api.themoviedb.org/3/movie/11',
+            responses=[
+                HTTPretty.Response(
+                    body='{"status_code": 25}',
+                    status=429,
+                    adding_headers={'Retry-After': '0.1'},
+                ),
+                HTTPretty.Response(
+                    body='{"title": "Star Wars"}',
+                    adding_headers={
+                        'X-RateLimit-Remaining': '0',
+                        'X-RateLimit-Reset': str(time.time() + 0.2),
+                    },
+                ),
+            ],
+        )
+        request.cache.stats(reset=True)
+        start = time.time()
+        self.assertEqual(
+            Request('movie/11').readJSON(), {'title': 'Star Wars'}
+        )
+        self.assertGreaterEqual(time.time() - start, 0.09)
+        self.assertEqual(len(httpretty.latest_requests()), 2)
+        self.assertEqual(request.cache.stats()['counters']['throttled'], 1)
+        # no requests remained until the reset time
+        self.assertGreater(request.limiter.acquire(), 0)
+
+    @httprettified
+    def test_retries_exhausted(self):
+        set_key(FAKE_API_KEY)
+        set_cache('null')
+        HTTPretty.register_uri(
+            HTTPretty.GET,
+            'http://api.themoviedb.org/3/movie/11',
+            body='{"status_code": 25}',
+            status=429,
+            adding_headers={'Retry-After': '0'},
+        )
+        with self.assertRaises(TMDBRequestError) as cm:
+            Request('movie/11').readJSON()
+        self.assertEqual(cm.exception.tmdberrno, 25)
+        self.assertEqual(
+            len(httpretty.latest_requests()), Request.retries + 1
+        )
+
+
+class StubConnection(object):
+    # idle connection failing with the given error once a request is sent
+    def __init__(self, error, sent):
+        self.error = error
+        self.sent = sent
+
+    def request(self, method, url, body=None, headers=None):
+        self.sent.append(url)
+
+    def getresponse(self):
+        raise self.error
+
+    def close(self):
+        pass
+
+
+@httprettified
+class TestConnectionPool(TestCase):
+    def setUp(self):
+        set_key(FAKE_API_KEY)
+        set_cache('null')
+        HTTPretty.register_uri(
+            HTTPretty.GET,
+            'http://api.themoviedb.org/3/movie/11',
+            body='{"title": "Star Wars"}',
+            adding_headers={'Connection': 'keep-alive'},
+        )
+
+    def tearDown(self):
+        request.pool.configure()
+
+    def _idle(self, pool):
+        return pool._idle.get(('http', 'api.themoviedb.org'), [])
+
+    def test_reuse(self):
+        Request('movie/11').readJSON()
+        conn = self._idle(request.pool)[0][0]
+        for i in range(2):
+            self.assertEqual(
+                Request('movie/11').readJSON(), {'title': 'Star Wars'}
+            )
+            # the same connection was used again
+            idle = self._idle(request.pool)
+            self.assertEqual(len(idle), 1)
+            self.assertIs(idle[0][0], conn)
+
+    def test_idle_timeout(self):
+        pool = ConnectionPool(idle_timeout=0)
+        url = urllib.request.Request('http://api.themoviedb.org/3/movie/11')
+        pool.urlopen(url)
+        conn = self._idle(pool)[0][0]
+        time.sleep(0.01)
+        self.assertEqual(pool.urlopen(url).read(), b'{"title": "Star Wars"}')
+        self.assertIsNot(self._idle(pool)[0][0], conn)
+
+    def test_http_error(self):
+        pool = ConnectionPool()
+        HTTPretty.register_uri(
+            HTTPretty.GET,
+            'http://api.themoviedb.org/3/movie/0',
+            body='{"status_code": 34}',
+            status=404,
+        )
+        url = urllib.request.Request('http://api.themoviedb.org/3/movie/0')
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            pool.urlopen(url)
+        self.assertEqual(cm.exception.code, 404)
+        self.assertEqual(cm.exception.read(), b'{"status_code": 34}')
+
+    def _stale(self, pool, error, sent):
+        pool._idle[('http', 'api.themoviedb.org')] = [
+            (StubConnection(error, sent), time.monotonic()) for i in range(4)
+        ]
+
+    def test_stale_retried_once(self):
+        pool = ConnectionPool()
+        url = urllib.request.Request('http://api.themoviedb.org/3/movie/11')
+        sent = []
+        self._stale(pool, http.client.RemoteDisconnected(), sent)
+        with self.assertRaises(urllib.error.URLError):
+            pool.urlopen(url)
+        self.assertEqual(len(sent), 2)
+        # timeouts are not retried, the request may have been processed
+        sent = []
+        self._stale(pool, socket.timeout(), sent)
+        with self.assertRaises(urllib.error.URLError):
+            pool.urlopen(url)
+        self.assertEqual(len(sent), 1)
+
+    def test_fork(self):
+        pool = ConnectionPool()
+        url = urllib.request.Request('http://api.themoviedb.org/3/movie/11')
+        pool.urlopen(url)
+        conn = self._idle(pool)[0][0]
+        with patch('tmdb3.http_pool.os.getpid', return_value=os.getpid() + 1):
+            pool.urlopen(url)
+            # a new connection, leaving the parent's socket open
+            self.assertIsNot(self._idle(pool)[0][0], conn)
+            self.assertEqual(len(self._idle(pool)), 1)
+            self.assertIsNotNone(conn.sock)
+
+    def test_redirect_post(self):
+        pool = ConnectionPool()
+        HTTPretty.register_uri(
+            HTTPretty.POST,
+            'http://api.themoviedb.org/3/list',
+            status=303,
+            location='http://api.themoviedb.org/3/list/1',
+        )
+        HTTPretty.register_uri(
+            HTTPretty.GET,
+            'http://api.themoviedb.org/3/list/1',
+            body='{"id": "1"}',
+        )
+        url = urllib.request.Request(
+            'http://api.themoviedb.org/3/list',
+            data=b'{"name": "list"}',
+            headers={'Content-Type': 'application/json'},
+        )
+        self.assertEqual(pool.urlopen(url).read(), b'{"id": "1"}')
+        last = HTTPretty.last_request
+        self.assertEqual(last.method, 'GET')
+        self.assertEqual(last.body, b'')
+        self.assertNotIn('Content-Type', last.headers)
+
+
+@httprettified
+class TestCompression(TestCase):
+    def setUp(self):
+        set_key(FAKE_API_KEY)
+        set_cache('null')
+
+    def _register(self, path, body, encoding, status=200):
+        HTTPretty.register_uri(
+            HTTPretty.GET,
+            'http://api.themoviedb.org/3/' + path,
+            body=body,
+            status=status,
+            adding_headers={'Content-Encoding': encoding},
+        )
+
+    def test_gzip(self):
+        self._register(
+            'movie/11', gzip.compress(b'{"title": "Star Wars"}'), 'gzip'
+        )
+        self.assertEqual(
+            Request('movie/11').readJSON(), {'title': 'Star Wars'}
+        )
+        self.assertIn(
+            'gzip', httpretty.last_request().headers['Accept-Encoding']
+        )
+
+    def test_deflate(self):
+        body = b'{"title": "Star Wars"}'
+        for data in (zlib.compress(body), zlib.compress(body)[2:-4]):
+            # zlib wrapped, and raw deflate streams
+            self._register('movie/11', data, 'deflate')
+            self.assertEqual(
+                Request('movie/11').readJSON(), {'title': 'Star Wars'}
+            )
+
+    def test_gzip_error(self):
+        # the TMDB status is read from compressed error responses
+        self._register(
+            'movie/11',
+            gzip.compress(b'{"status_code": 7, "status_message": "No"}'),
+            'gzip',
+            status=401,
+        )
+        with self.assertRaises(TMDBKeyInvalid) as cm:
+            Request('movie/11').readJSON()
+        self.assertEqual(cm.exception.tmdberrno, 7)
@@ -22,7 +22,7 @@ from .tmdb_api import (
     Episode,
     Season,
 )
-from .request import set_key, set_cache
+from .request import set_key, set_cache, set_lifetime, set_rate_limit
 from .locales import get_locale, set_locale
 from .tmdb_auth import get_session, set_session
 from .cache_engine import CacheEngine
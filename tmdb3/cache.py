@@ -7,16 +7,38 @@
 # Purpose: Caching framework to store TMDb API results
 # -----------------------
 
+from contextlib import contextmanager
+from functools import partial
+import threading
+import atexit
+import json
+import gzip
 import time
 
 from .tmdb_exceptions import *
-from .cache_engine import Engines
+from .cache_engine import Engines, CacheObject
+from .cache_stats import CacheStats
 
 from .cache_null import *
 from .cache_file import *
+from .cache_sqlite import *
+from .cache_memory import *
 
 DEBUG = False
 
+# snapshots are gzipped text, with a JSON header line, followed by one line
+# per entry holding a JSON list of key, data, lifetime and creation time
+SNAPSHOT_VERSION = 1
+
+
+class _Flight(object):
+    """A call in progress for a key, waited on by other callers."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
 
 class Cache(object):
     """
@@ -33,28 +55,64 @@ class Cache(object):
 
     def __init__(self, engine=None, *args, **kwargs):
         self._engine = None
+        self._hot = None
         self._data = {}
         self._age = 0
-        self._rate_limiter = []
+        self._refreshing = set()
+        self._flights = {}
+        self._batch = threading.local()
+        self._lock = threading.Lock()
+        self._queue = threading.Condition()
+        self._queued = {}
+        self._writer = None
+        self._atexit = False
+        self.stale = 0
+        self.write_behind = False
+        self.hits = {"hot": 0, "engine": 0, "stale": 0}
+        self.misses = 0
+        self.metrics = CacheStats()
+        self._reporter = None
+        self._reported = 0
         self.configure(engine, *args, **kwargs)
 
     def _import(self, data=None):
         if data is None:
             data = self._engine.get(self._age)
         for obj in sorted(data, key=lambda x: x.creation):
-            self._rate_limiter.append(obj.creation)
-            if len(self._rate_limiter) > 30:
-                self._rate_limiter.pop(0)
-            if not obj.expired:
+            if not (obj.expired or self._engine.indexed):
                 self._data[obj.key] = obj
                 self._age = max(self._age, obj.creation)
 
     def _expire(self):
         for k, v in list(self._data.items()):
-            if v.expired:
+            if v.outdated(self.stale):
                 del self._data[k]
 
-    def configure(self, engine, *args, **kwargs):
+    def configure(
+        self,
+        engine,
+        *args,
+        hot_entries=0,
+        stale=0,
+        write_behind=False,
+        **kwargs
+    ):
+        """
+        Select the engine to use, passing any further arguments on to it.
+        `hot_entries` enables an in-process tier in front of the engine,
+        holding that many of the most recently used entries. `stale` is
+        how many seconds past expiry entries may still be served from
+        cached functions, while a fresh copy is fetched in the background.
+        `write_behind` returns from put() at once, leaving the data to be
+        written to the engine from a background thread.
+        """
+        # anything queued belongs to the current engine
+        self.flush()
+        self.stale = stale
+        self.write_behind = write_behind
+        if write_behind and not self._atexit:
+            atexit.register(self.flush)
+            self._atexit = True
         if engine is None:
             engine = "file"
         elif engine not in Engines:
@@ -62,31 +120,337 @@ class Cache(object):
         self._engine = Engines[engine](self)
         self._engine.configure(*args, **kwargs)
 
+        self._hot = None
+        if hot_entries:
+            self._hot = MemoryEngine(self)
+            self._hot.configure(max_bytes=None, max_entries=hot_entries)
+
     def put(self, key, data, lifetime=60 * 60 * 12):
         # pull existing data, so cache will be fresh when written back out
         if self._engine is None:
             raise TMDBCacheError("No cache engine configured")
-        self._expire()
-        self._import(self._engine.put(key, data, lifetime))
+        pending = getattr(self._batch, "pending", None)
+        if pending is not None:
+            # written out at the end of the batch
+            pending[key] = CacheObject(key, data, lifetime)
+            return
+        if self.write_behind:
+            self._enqueue([CacheObject(key, data, lifetime)])
+            return
+        with self.metrics.timer("put"):
+            self._expire()
+            self._import(self._engine.put(key, data, lifetime))
+            if self._hot is not None:
+                self._hot.put(key, data, lifetime)
+        self._report()
 
-    def get(self, key):
+    @contextmanager
+    def batch(self):
+        """
+        Hold back anything put into the cache by the current thread for the
+        duration of the context, writing it all out to the engine in a
+        single operation at the end, even if an error is raised. Data held
+        back is returned from get() meanwhile. Nested batches are written
+        out with the outermost one.
+        """
         if self._engine is None:
             raise TMDBCacheError("No cache engine configured")
-        self._expire()
+        if getattr(self._batch, "pending", None) is not None:
+            yield
+            return
+        self._batch.pending = {}
+        try:
+            yield
+        finally:
+            pending = self._batch.pending
+            self._batch.pending = None
+            if pending and self.write_behind:
+                self._enqueue(list(pending.values()))
+            elif pending:
+                self._put_many(list(pending.values()))
+
+    def _enqueue(self, objs):
+        with self._queue:
+            for obj in objs:
+                # replaces any older data queued for the same key
+                self._queued[obj.key] = obj
+            self._start_writer()
+            self._queue.notify_all()
+
+    def _start_writer(self):
+        if (self._writer is None) or not self._writer.is_alive():
+            # not yet started, or lost across a fork
+            self._writer = threading.Thread(
+                target=self._write_queued, name="tmdb3-writer"
+            )
+            self._writer.daemon = True
+            self._writer.start()
+
+    def _write_queued(self):
+        while True:
+            with self._queue:
+                while not self._queued:
+                    self._queue.wait()
+                objs = list(self._queued.values())
+            try:
+                self._put_many(objs)
+            except Exception as e:
+                # drop the data rather than retry forever, it will be
+                # fetched and cached again on a later miss
+                self.metrics.count("write_errors")
+                if DEBUG:
+                    print("writing to cache failed: {0}".format(e))
+            with self._queue:
+                for obj in objs:
+                    if self._queued.get(obj.key) is obj:
+                        del self._queued[obj.key]
+                self._queue.notify_all()
+
+    def flush(self):
+        """Wait for any data queued by write_behind to reach the engine."""
+        with self._queue:
+            if self._queued:
+                self._start_writer()
+            while self._queued:
+                self._queue.wait()
+
+    def _put_many(self, objs):
+        with self.metrics.timer("put"):
+            self._expire()
+            self._import(self._engine.put_many(objs))
+            if self._hot is not None:
+                for obj in objs:
+                    self._hot.add(obj)
+        self._report()
+
+    def _lookup(self, key):
+        if self._engine.indexed:
+            # engine can fetch the key directly, no need to pull everything
+            return self._engine.lookup(key)
         if key not in self._data:
             self._import()
+        return self._data.get(key)
+
+    def get(self, key, refresh=None):
+        """
+        Return the data stored for key, or None if there is none. If a
+        `refresh` callable is given, data that expired within the `stale`
+        period is returned as well, with `refresh` called in a background
+        thread to store a fresh copy.
+        """
+        if self._engine is None:
+            raise TMDBCacheError("No cache engine configured")
         try:
-            return self._data[key].data
-        except:
-            # no cache data, so we're going to query
-            # wait to ensure proper rate limiting
-            if len(self._rate_limiter) == 30:
-                w = 10 - (time.time() - self._rate_limiter.pop(0))
-                if w > 0:
-                    if DEBUG:
-                        print("rate limiting - waiting {0} seconds".format(w))
-                    time.sleep(w)
-            return None
+            with self.metrics.timer("get"):
+                return self._get(key, refresh)
+        finally:
+            self._report()
+
+    def _get(self, key, refresh):
+        pending = getattr(self._batch, "pending", None)
+        queued = pending.get(key) if pending else None
+        if (queued is None) and self._queued:
+            queued = self._queued.get(key)
+        if (queued is not None) and not queued.expired:
+            # put in the current batch or write queue, not yet written out
+            self.hits["hot"] += 1
+            self.metrics.lookup(key, True)
+            return queued.data
+
+        obj = None
+        if self._hot is not None:
+            obj = self._hot.lookup(key)
+            if (obj is not None) and not obj.expired:
+                self.hits["hot"] += 1
+                self.metrics.lookup(key, True)
+                return obj.data
+
+        self._expire()
+        found = self._lookup(key)
+        if found is not None:
+            obj = found
+            if self._hot is not None:
+                self._hot.add(obj)
+        if obj is not None:
+            if not obj.expired:
+                self.hits["engine"] += 1
+                self.metrics.lookup(key, True)
+                return obj.data
+            if refresh is not None:
+                self.hits["stale"] += 1
+                self.metrics.lookup(key, True)
+                self._refresh(key, refresh)
+                return obj.data
+        self.misses += 1
+        self.metrics.lookup(key, False)
+        return None
+
+    def stats(self, reset=False):
+        """
+        Return the hit and miss counts of the cache, along with the
+        metrics collected since the last reset: per endpoint hits and
+        misses, bytes read and written by the engine, and histograms of
+        the time spent in get, put, waiting for file locks, and sleeping
+        for rate limiting of requests.
+        """
+        stats = self.metrics.asdict()
+        stats["hits"] = dict(self.hits)
+        stats["misses"] = self.misses
+        if reset:
+            self.metrics.reset()
+            self.hits = {"hot": 0, "engine": 0, "stale": 0}
+            self.misses = 0
+        return stats
+
+    def report(self, callback, interval=60):
+        """
+        Pass stats() to callback at most every `interval` seconds, checked
+        as the cache is used. A callback of None stops reporting.
+        """
+        self._reporter = None
+        if callback is not None:
+            self._reporter = (callback, interval)
+        self._reported = time.time()
+
+    def _report(self):
+        if self._reporter is None:
+            return
+        callback, interval = self._reporter
+        now = time.time()
+        if now - self._reported < interval:
+            return
+        self._reported = now
+        try:
+            callback(self.stats())
+        except Exception as e:
+            # reporting must never break the caller
+            if DEBUG:
+                print("stats callback failed: {0}".format(e))
+
+    def dump(self, filename):
+        """
+        Write all live entries of the engine to a snapshot file, which may
+        be loaded into any engine with restore(). Returns the number of
+        entries written.
+        """
+        if self._engine is None:
+            raise TMDBCacheError("No cache engine configured")
+        self.flush()
+        count = 0
+        with gzip.open(filename, "wt") as fd:
+            fd.write(json.dumps({"snapshot": SNAPSHOT_VERSION}) + "\n")
+            for obj in self._engine.dump():
+                if obj.expired:
+                    continue
+                fd.write(
+                    json.dumps([obj.key, obj.data, obj.lifetime, obj.creation])
+                    + "\n"
+                )
+                count += 1
+        return count
+
+    def restore(self, filename):
+        """
+        Load the live entries of a snapshot file written by dump() into the
+        engine, in a single operation. Entries already cached with a later
+        creation time are kept. Returns the number of entries loaded.
+        """
+        if self._engine is None:
+            raise TMDBCacheError("No cache engine configured")
+        try:
+            with gzip.open(filename, "rt") as fd:
+                header = json.loads(fd.readline())
+                if header.get("snapshot") != SNAPSHOT_VERSION:
+                    raise ValueError
+                objs = [CacheObject(*json.loads(line)) for line in fd]
+        except (IOError, OSError, ValueError, AttributeError, TypeError):
+            raise TMDBCacheError("Invalid cache snapshot: " + filename)
+        objs = [obj for obj in objs if not obj.expired]
+        self._engine.restore(objs)
+        return len(objs)
+
+    def _refresh(self, key, refresh):
+        with self._lock:
+            if key in self._refreshing:
+                # already being fetched
+                return
+            self._refreshing.add(key)
+
+        def run():
+            try:
+                refresh()
+            except Exception as e:
+                # keep serving the stale copy, and retry on a later call
+                if DEBUG:
+                    print("refreshing {0} failed: {1}".format(key, e))
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        thread = threading.Thread(target=run, name="tmdb3-refresh")
+        thread.daemon = True
+        thread.start()
+
+    def _flight(self, key, func):
+        """
+        Return the result of func, called for a key not found in the cache.
+        Should another thread already be calling it for the same key, wait
+        for that call instead, and share its result or error. Should
+        another process be doing so through a shared engine, wait for it
+        and read its result from the cache.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            self.metrics.count("coalesced")
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            with self._engine.claim(key) as waited:
+                if waited:
+                    # another process was fetching the key, and has
+                    # likely stored it meanwhile
+                    obj = self._lookup(key)
+                    if (obj is not None) and not obj.expired:
+                        flight.result = obj.data
+                if flight.result is None:
+                    flight.result = func()
+                    if self._engine.claims:
+                        # processes waiting on the claim read it from the
+                        # engine, it cannot be held back until later
+                        self._write_through(key)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    def _write_through(self, key):
+        """
+        Write out data for key held back by the current batch or queued by
+        write_behind, ahead of anything else.
+        """
+        pending = getattr(self._batch, "pending", None)
+        obj = pending.pop(key, None) if pending else None
+        if obj is None:
+            with self._queue:
+                obj = self._queued.get(key)
+        if obj is None:
+            return
+        self._put_many([obj])
+        with self._queue:
+            if self._queued.get(key) is obj:
+                del self._queued[key]
+                self._queue.notify_all()
 
     def cached(self, callback):
         """
@@ -130,15 +494,31 @@ class Cache(object):
                 return self.func(*args, **kwargs)
             else:
                 key = self.callback()
-                data = self.cache.get(key)
+                refresh = None
+                if self.cache.stale:
+                    refresh = partial(self._update, key, *args, **kwargs)
+                data = self.cache.get(key, refresh)
                 if data is None:
-                    data = self.func(*args, **kwargs)
-                    if hasattr(self.inst, "lifetime"):
-                        self.cache.put(key, data, self.inst.lifetime)
-                    else:
-                        self.cache.put(key, data)
+                    # concurrent misses for the same key share one call
+                    data = self.cache._flight(
+                        key, partial(self._update, key, *args, **kwargs)
+                    )
                 return data
 
+        def _update(self, key, *args, **kwargs):
+            data = self.func(*args, **kwargs)
+            self._store(key, data)
+            return data
+
+        def _store(self, key, data):
+            if hasattr(self.inst, "cache_lifetime"):
+                # lifetime depends on the response
+                self.cache.put(key, data, self.inst.cache_lifetime(data))
+            elif hasattr(self.inst, "lifetime"):
+                self.cache.put(key, data, self.inst.lifetime)
+            else:
+                self.cache.put(key, data)
+
         def __get__(self, inst, owner):
             if inst is None:
                 return self
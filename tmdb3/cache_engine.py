@@ -7,6 +7,7 @@
 # Purpose: Base cache engine class for collecting registered engines
 # -----------------------
 
+from contextlib import contextmanager
 import time
 from weakref import ref
 
@@ -48,6 +49,12 @@ class CacheEngineType(type):
 
 class CacheEngine(object, metaclass=CacheEngineType):
     name = "unspecified"
+    # engines able to fetch a single key directly set this, and are then
+    # queried through lookup() rather than mirrored into Cache._data
+    indexed = False
+    # engines whose claim() holds back other processes set this, and are
+    # given data fetched under a claim before it is released
+    claims = False
 
     def __init__(self, parent):
         self.parent = ref(parent)
@@ -61,9 +68,64 @@ class CacheEngine(object, metaclass=CacheEngineType):
     def put(self, key, value, lifetime):
         raise RuntimeError
 
+    def put_many(self, objects):
+        """
+        Store the given objects in as few operations as the engine allows,
+        returning any new objects like put().
+        """
+        newobjs = []
+        for obj in objects:
+            newobjs.extend(self.put(obj.key, obj.data, obj.lifetime))
+        return newobjs
+
+    def lookup(self, key):
+        raise RuntimeError
+
     def expire(self, key):
         raise RuntimeError
 
+    def dump(self):
+        """Return all live objects stored by the engine."""
+        return self.get(0)
+
+    def restore(self, objects):
+        """
+        Store the given objects in a single operation, retaining their
+        creation time. Objects already stored with a later creation time
+        are kept instead.
+        """
+        raise RuntimeError
+
+    @contextmanager
+    def claim(self, key):
+        """
+        Hold a claim over fetching a key missing from the cache, for the
+        duration of the context. Engines shared between processes wait for
+        any claim another process holds, and yield True if they did, in
+        which case the key has likely been stored meanwhile.
+        """
+        yield False
+
+    @property
+    def grace(self):
+        """
+        Seconds past expiry that entries are still returned from lookup(),
+        so the cache may serve them while fetching a fresh copy.
+        """
+        return getattr(self.parent(), "stale", 0)
+
+    def _count(self, name, value=1):
+        """Add to a counter in the metrics of the parent cache."""
+        metrics = getattr(self.parent(), "metrics", None)
+        if metrics is not None:
+            metrics.count(name, value)
+
+    def _time(self, name, seconds):
+        """Record a duration in the metrics of the parent cache."""
+        metrics = getattr(self.parent(), "metrics", None)
+        if metrics is not None:
+            metrics.time(name, seconds)
+
 
 class CacheObject(object):
     """
@@ -83,6 +145,10 @@ class CacheObject(object):
     def expired(self):
         return self.remaining == 0
 
+    def outdated(self, grace=0):
+        """Return whether the object expired over `grace` seconds ago."""
+        return (self.creation + self.lifetime + grace) <= time.time()
+
     @property
     def remaining(self):
         return max((self.creation + self.lifetime) - time.time(), 0)
@@ -9,14 +9,20 @@
 #          access.
 # -----------------------
 
+import hashlib
+import mmap
+import contextlib
+import marshal
+import pickle
 import struct
+import threading
+import zlib
 import errno
+import time
 import json
 import os
 import io
 
-from io import StringIO
-
 from .tmdb_exceptions import *
 from .cache_engine import CacheEngine, CacheObject
 
@@ -24,31 +30,178 @@ from .cache_engine import CacheEngine, CacheObject
 # Cache File Format
 # -----------------
 # cache version         (2) unsigned short
-# slot count            (2) unsigned short
+# flags                 (2) unsigned short, reserved
+# slot count            (4) unsigned int
+# slots used            (4) unsigned int
+# bucket count          (4) unsigned int
+# bucket 0: slot        (4) unsigned int
+# bucket 1: slot            the index is an open addressing hash table,
+#   ....                    mapping a digest of the key to the slot
+# bucket M-1: slot          holding it. buckets store slot number plus
+#                           one, with zero marking an empty bucket, and
+#                           collisions probe forward to the next bucket.
 # slot 0: timestamp     (8) double
 # slot 0: lifetime      (4) unsigned int
-# slot 0: seek point    (4) unsigned int
+# slot 0: seek point    (8) unsigned long long
+# slot 0: size          (4) unsigned int
+# slot 0: flags         (4) unsigned int, block encoding
+# slot 0: key digest    (8) unsigned long long
 # slot 1: timestamp
-# slot 1: lifetime          index slots are IDd by their query date and
-# slot 1: seek point        are filled incrementally forwards. lifetime
-#   ....                    is how long after query date before the item
-#   ....                    expires, and seek point is the location of the
-# slot N-2: timestamp       start of data for that entry. 256 empty slots
-# slot N-2: lifetime        are pre-allocated, allowing fast updates.
-# slot N-2: seek point      when all slots are filled, the cache file is
-# slot N-1: timestamp       rewritten from scratch to add more slots.
-# slot N-1: lifetime
-# slot N-1: seek point
-# block 1               (?) ASCII
+#   ....                    slots are filled incrementally forwards, in
+#   ....                    order of query date. lifetime is how long
+# slot N-1: timestamp       after query date before the item expires,
+# slot N-1: lifetime        seek point and size locate the data for that
+# slot N-1: seek point      entry, and the key digest allows resolving
+# slot N-1: size            the index without decoding the data. 256
+# slot N-1: flags           empty slots are pre-allocated, allowing fast
+# slot N-1: key digest      updates. when all slots are filled, the cache
+#                           file is rewritten from scratch to add more
+#                           slots, dropping any expired entries. flags
+#                           record how the data block is encoded, the
+#                           low four bits holding the compression codec
+#                           and the next four the serializer.
+# block 1               (?) ASCII, binary or zlib
 # block 2
-#    ....                   blocks are just simple ASCII text, generated
-#    ....                   as independent objects by the JSON encoder
+#    ....                   blocks are independent objects, generated by
+#    ....                   the JSON encoder by default, or by another
+#    ....                   registered serializer, optionally compressed
+#    ....                   with zlib
 # block N-2
 # block N-1
 #
+# A Bloom filter over the key digests is kept beside the cache file, in
+# the same file name with a ".bloom" suffix, as a plain bit array. Bits
+# are only ever set while holding the exclusive lock, and cleared by a
+# compaction rebuilding the filter, so readers may test it without locking.
 ####################
 
 
+def digest(key):
+    """Return the 64-bit digest used to index a cache key."""
+    return int.from_bytes(
+        hashlib.blake2b(key.encode(), digest_size=8).digest(), "little"
+    )
+
+
+class BloomFilter(object):
+    """
+    Bloom filter over the digests of cached keys, held in a file mapped
+    into memory and shared between processes. Keys are never removed, so
+    the filter only errs in reporting a key that was not stored.
+    """
+
+    hashes = 4
+    _mask = 0xFFFFFFFFFFFFFFFF
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.bits = 0
+        self._mmap = None
+
+    def open(self, bits):
+        """
+        Map the filter file, creating it with the given number of bits if
+        it does not exist. An existing filter keeps its size, as other
+        processes may have it mapped. Returns True if the filter is new,
+        and must be filled with any keys already stored.
+        """
+        fd = os.open(
+            self.filename, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0)
+        )
+        try:
+            size = os.fstat(fd).st_size
+            new = not size
+            if new:
+                size = (bits + 7) // 8
+                os.ftruncate(fd, size)
+            self._mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.bits = size * 8
+        return new
+
+    def _positions(self, keydigest):
+        for i in range(self.hashes):
+            # derive independent positions by remixing the digest
+            x = (keydigest ^ (0x9E3779B97F4A7C15 * (i + 1))) & self._mask
+            x = (x * 0xBF58476D1CE4E5B9) & self._mask
+            yield (x ^ (x >> 31)) % self.bits
+
+    def add(self, keydigest):
+        for i in self._positions(keydigest):
+            self._mmap[i >> 3] |= 1 << (i & 7)
+
+    def __contains__(self, keydigest):
+        return all(
+            self._mmap[i >> 3] & (1 << (i & 7))
+            for i in self._positions(keydigest)
+        )
+
+    def reset(self, digests):
+        """Replace the contents of the filter by the given digests."""
+        bits = bytearray(len(self._mmap))
+        for keydigest in digests:
+            for i in self._positions(keydigest):
+                bits[i >> 3] |= 1 << (i & 7)
+        # bits of digests still stored are set both before and after, so
+        # readers never see them cleared while this is copied over
+        self._mmap[:] = bytes(bits)
+
+
+class Serializer(object):
+    """
+    Encoding used to store the key and data of a cache entry as a block,
+    identified in the slot flags by a number from 0 to 15.
+    """
+
+    def __init__(self, name, ident, dumps, loads):
+        self.name = name
+        self.ident = ident
+        self.dumps = dumps
+        self.loads = loads
+
+
+class Serializers(object):
+    """
+    Static collector for serializers, by name and identifier.
+    """
+
+    def __init__(self):
+        self._serializers = {}
+
+    def register(self, serializer):
+        if not (0 <= serializer.ident <= 15):
+            raise TMDBCacheError(
+                "Serializer identifier must be between 0 and 15."
+            )
+        self._serializers[serializer.name] = serializer
+        self._serializers[serializer.ident] = serializer
+
+    def __getitem__(self, key):
+        return self._serializers[key]
+
+    def __contains__(self, key):
+        return self._serializers.__contains__(key)
+
+
+Serializers = Serializers()
+Serializers.register(
+    Serializer("json", 0, lambda x: json.dumps(x).encode(), json.loads)
+)
+# marshal and pickle decode far faster than JSON, but should only be used
+# for caches shared between processes of the same python version, that
+# trust each other
+Serializers.register(Serializer("marshal", 1, marshal.dumps, marshal.loads))
+Serializers.register(
+    Serializer(
+        "pickle",
+        2,
+        lambda x: pickle.dumps(x, pickle.HIGHEST_PROTOCOL),
+        pickle.loads,
+    )
+)
+
+
 def _donothing(*args, **kwargs):
     pass
 
@@ -67,6 +220,7 @@ try:
 
         LOCK_EX = fcntl.LOCK_EX
         LOCK_SH = fcntl.LOCK_SH
+        LOCK_EX_NB = fcntl.LOCK_EX | fcntl.LOCK_NB
 
         def __init__(self, fileobj, operation, callback=None):
             self.fileobj = fileobj
@@ -83,6 +237,30 @@ try:
             fcntl.flock(self.fileobj, fcntl.LOCK_UN)
             return suppress
 
+    class RangeLock(object):
+        """
+        Exclusive lock over a single byte of a file descriptor. These are
+        record locks, held per process rather than per file object, so
+        they do not exclude other threads of the same process.
+        """
+
+        def __init__(self, fd, offset):
+            self.fd = fd
+            self.offset = offset
+
+        def acquire(self):
+            """Take the lock without blocking, returning if it was taken."""
+            try:
+                fcntl.lockf(
+                    self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, self.offset
+                )
+            except (IOError, OSError):
+                return False
+            return True
+
+        def release(self):
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, self.offset)
+
     def parse_filename(filename):
         if "$" in filename:
             # replace any environmental variables
@@ -103,6 +281,7 @@ except ImportError:
     class Flock(object):
         LOCK_EX = msvcrt.LK_LOCK
         LOCK_SH = msvcrt.LK_LOCK
+        LOCK_EX_NB = msvcrt.LK_NBLCK
 
         def __init__(self, fileobj, operation, callback=None):
             self.fileobj = fileobj
@@ -110,7 +289,7 @@ except ImportError:
             self.callback = callback
 
         def __enter__(self):
-            self.size = os.path.getsize(self.fileobj.name)
+            self.size = max(os.path.getsize(self.fileobj.name), 1)
             msvcrt.locking(self.fileobj.fileno(), self.operation, self.size)
 
         def __exit__(self, exc_type, exc_value, exc_tb):
@@ -120,6 +299,27 @@ except ImportError:
             msvcrt.locking(self.fileobj.fileno(), msvcrt.LK_UNLCK, self.size)
             return suppress
 
+    class RangeLock(object):
+        """Exclusive lock over a single byte of a file descriptor."""
+
+        def __init__(self, fd, offset):
+            self.fd = fd
+            self.offset = offset
+
+        def acquire(self):
+            """Take the lock without blocking, returning if it was taken."""
+            # locking applies from the current position of the descriptor
+            os.lseek(self.fd, self.offset, os.SEEK_SET)
+            try:
+                msvcrt.locking(self.fd, msvcrt.LK_NBLCK, 1)
+            except (IOError, OSError):
+                return False
+            return True
+
+        def release(self):
+            os.lseek(self.fd, self.offset, os.SEEK_SET)
+            msvcrt.locking(self.fd, msvcrt.LK_UNLCK, 1)
+
     def parse_filename(filename):
         if "%" in filename:
             # replace any environmental variables
@@ -140,45 +340,100 @@ except ImportError:
 
 
 class FileCacheObject(CacheObject):
-    _struct = struct.Struct("dII")  # double and two ints
-    #                               # timestamp, lifetime, position
+    _struct = struct.Struct("<dIQIIQ")  # timestamp, lifetime, position,
+    #                                   # size, flags and key digest
+
+    # block codecs, stored in the low bits of the slot flags
+    CODEC_MASK = 0x0F
+    CODEC_NONE = 0x00
+    CODEC_ZLIB = 0x01
+    # serializer identifier, stored in the next bits of the slot flags
+    SERIALIZER_MASK = 0xF0
+    SERIALIZER_SHIFT = 4
+    # blocks smaller than this are not worth compressing
+    compress_min = 256
 
     @classmethod
     def fromFile(cls, fd):
-        dat = cls._struct.unpack(fd.read(cls._struct.size))
+        return cls.fromBytes(fd.read(cls._struct.size))
+
+    @classmethod
+    def fromBytes(cls, buff):
+        dat = cls._struct.unpack(buff)
         obj = cls(None, None, dat[1], dat[0])
-        obj.position = dat[2]
+        obj.position, obj.size, obj.flags, obj.digest = dat[2:]
         return obj
 
     def __init__(self, *args, **kwargs):
         self._key = None
         self._data = None
         self._size = None
-        self._buff = StringIO()
+        self._buff = None
+        self.position = 0
+        self.flags = 0
+        self.digest = 0
+        self.compress = False
+        self.serializer = "json"
         super(FileCacheObject, self).__init__(*args, **kwargs)
 
     @property
     def size(self):
         if self._size is None:
-            self._buff.seek(0, 2)
-            size = self._buff.tell()
-            if size == 0:
-                if (self._key is None) or (self._data is None):
-                    raise RuntimeError
-                json.dump([self.key, self.data], self._buff)
-                self._size = self._buff.tell()
-            self._size = size
+            if (self._key is None) or (self._data is None):
+                raise RuntimeError
+            self._encode()
+            self._size = len(self._buff)
         return self._size
 
     @size.setter
     def size(self, value):
         self._size = value
 
+    def _encode(self):
+        serializer = Serializers[self.serializer]
+        try:
+            buff = serializer.dumps([self._key, self._data])
+        except Exception:
+            # data not supported by the serializer, fall back to JSON
+            serializer = Serializers["json"]
+            buff = serializer.dumps([self._key, self._data])
+        self.flags = serializer.ident << self.SERIALIZER_SHIFT
+        if self.compress and (len(buff) >= self.compress_min):
+            compressed = zlib.compress(buff)
+            if len(compressed) < len(buff):
+                buff = compressed
+                self.flags |= self.CODEC_ZLIB
+        self._buff = buff
+
+    @property
+    def trusted(self):
+        """
+        Whether the block was encoded by JSON or by the serializer this
+        object was configured with, the only ones it may be decoded with,
+        as the cache file may have been written by someone else.
+        """
+        ident = (self.flags & self.SERIALIZER_MASK) >> self.SERIALIZER_SHIFT
+        return ident in (
+            Serializers["json"].ident,
+            Serializers[self.serializer].ident,
+        )
+
+    def _decode(self):
+        if not self.trusted:
+            raise TMDBCacheError("Untrusted cache block serializer.")
+        buff = self._buff
+        if (self.flags & self.CODEC_MASK) == self.CODEC_ZLIB:
+            buff = zlib.decompress(buff)
+        serializer = Serializers[
+            (self.flags & self.SERIALIZER_MASK) >> self.SERIALIZER_SHIFT
+        ]
+        self._key, self._data = serializer.loads(buff)
+
     @property
     def key(self):
-        if self._key is None:
+        if self._key is None and self._buff is not None:
             try:
-                self._key, self._data = json.loads(self._buff.getvalue())
+                self._decode()
             except:
                 pass
         return self._key
@@ -186,51 +441,116 @@ class FileCacheObject(CacheObject):
     @key.setter
     def key(self, value):
         self._key = value
+        if value is not None:
+            self.digest = digest(value)
 
     @property
     def data(self):
         if self._data is None:
-            self._key, self._data = json.loads(self._buff.getvalue())
+            self._decode()
         return self._data
 
     @data.setter
     def data(self, value):
         self._data = value
 
-    def load(self, fd):
-        fd.seek(self.position)
-        self._buff.seek(0)
-        self._buff.write(fd.read(self.size).decode())
-
     def dumpslot(self, fd):
-        pos = fd.tell()
         fd.write(
-            self._struct.pack(self.creation, self.lifetime, self.position)
+            self._struct.pack(
+                self.creation,
+                self.lifetime,
+                self.position,
+                self.size,
+                self.flags,
+                self.digest,
+            )
         )
 
     def dumpdata(self, fd):
         self.size
         fd.seek(self.position)
-        fd.write(self._buff.getvalue().encode())
+        fd.write(self._buff)
 
 
 class FileEngine(CacheEngine):
     """Simple file-backed engine."""
 
     name = "file"
-    _struct = struct.Struct("HH")  # two shorts for version and count
-    _version = 2
+    indexed = True
+    claims = True
+    _struct = struct.Struct("<HHIII")  # version, flags, slot count,
+    #                                  # slots used and bucket count
+    _bucket = struct.Struct("<I")
+    _version = 3
+    _flight_range = 2 ** 20
 
     def __init__(self, parent):
         super(FileEngine, self).__init__(parent)
+        # flock does not exclude threads sharing the same file object
+        self._thread_lock = threading.RLock()
+        self._mmap = None
+        self._mapped = None
+        self._bloom = None
+        self._flightfd = None
         self.configure(None)
 
-    def configure(self, filename, preallocate=256):
+    def configure(
+        self,
+        filename,
+        preallocate=256,
+        compact_ratio=0.5,
+        compact_interval=256,
+        use_mmap=False,
+        compress=False,
+        serializer="json",
+        shards=1,
+        bloom_bits=2 ** 20,
+        flight_timeout=10,
+    ):
+        if serializer not in Serializers:
+            raise TMDBCacheError(
+                "Invalid cache serializer specified: " + serializer
+            )
         self.preallocate = preallocate
+        self.use_mmap = use_mmap
+        self.compress = compress
+        self.serializer = serializer
+        self.compact_ratio = compact_ratio
+        self.compact_interval = compact_interval
+        self.bloom_bits = bloom_bits
+        self.flight_timeout = flight_timeout
+        self._bloom = None
         self.cachefile = filename
         self.size = 0
-        self.free = 0
+        self.used = 0
+        self.buckets = 0
         self.age = 0
+        self._puts = 0
+
+        self._shards = []
+        if shards > 1:
+            if filename is None:
+                raise TMDBCacheError("No cache filename given.")
+            # each shard is a complete cache file with its own lock,
+            # selected by the key digest
+            for i in range(shards):
+                shard = FileEngine(self.parent())
+                shard.configure(
+                    "{0}.{1}".format(filename, i),
+                    preallocate,
+                    compact_ratio,
+                    compact_interval,
+                    use_mmap,
+                    compress,
+                    serializer,
+                    bloom_bits=bloom_bits,
+                    flight_timeout=flight_timeout,
+                )
+                self._shards.append(shard)
+
+    def _shard(self, key):
+        # use the high bits, the low bits select the bucket in the shard
+        return self._shards[(digest(key) >> 32) % len(self._shards)]
 
     def _init_cache(self):
         # only run this once
@@ -239,6 +559,9 @@ class FileEngine(CacheEngine):
         if self.cachefile is None:
             raise TMDBCacheError("No cache filename given.")
         self.cachefile = parse_filename(self.cachefile)
+        # put() reports entries stored from now on, there is no need to
+        # walk everything stored by previous processes
+        self.age = time.time()
 
         try:
             # attempt to read existing cache at filename
@@ -271,33 +594,273 @@ class FileEngine(CacheEngine):
                 # let the unhandled error continue through
                 raise
 
+    @contextlib.contextmanager
+    def _lock(self, operation):
+        """
+        Flock the cache file for the duration of the context, following
+        the file to its new location if it was replaced by a compaction
+        while waiting for the lock.
+        """
+        with self._thread_lock:
+            self._init_cache()
+            while True:
+                self._open("r+b")
+                start = time.time()
+                with Flock(self.cachefd, operation):
+                    self._time("lock_wait", time.time() - start)
+                    if not self._replaced():
+                        if self.use_mmap:
+                            # another process may have grown or truncated
+                            # the file since it was last mapped
+                            self._remap()
+                        yield
+                        return
+                self._unmap()
+                self.cachefd.close()
+
+    def _replaced(self):
+        try:
+            current = os.stat(self.cachefile)
+        except OSError:
+            # file was removed from under us, keep using the open one
+            return False
+        opened = os.fstat(self.cachefd.fileno())
+        return (current.st_dev, current.st_ino) != (
+            opened.st_dev,
+            opened.st_ino,
+        )
+
+    def _remap(self):
+        # make any buffered writes visible through the mapping
+        self.cachefd.flush()
+        stat = os.fstat(self.cachefd.fileno())
+        # a file replaced by a compaction may have grown back to the size
+        # of the mapping, which would still show the old one
+        mapped = (stat.st_dev, stat.st_ino, stat.st_size)
+        if (self._mmap is not None) and (self._mapped == mapped):
+            return
+        self._unmap()
+        if stat.st_size:
+            self._mmap = mmap.mmap(
+                self.cachefd.fileno(), stat.st_size, access=mmap.ACCESS_READ
+            )
+            self._mapped = mapped
+
+    def _unmap(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+            self._mapped = None
+
+    def _pread(self, position, size):
+        """Read size bytes at position in the cache file."""
+        if self.use_mmap:
+            if (self._mmap is None) or (position + size > len(self._mmap)):
+                # file was extended by this process while locked
+                self._remap()
+            if self._mmap is not None:
+                return self._mmap[position:position + size]
+        self.cachefd.seek(position)
+        return self.cachefd.read(size)
+
+    def _load(self, obj, position=None):
+        """Read the data block for an object from the cache file."""
+        if position is None:
+            position = obj.position
+        obj._buff = self._pread(position, obj.size)
+        self._count("bytes_read", obj.size)
+
+    def _filter(self):
+        """
+        Return the Bloom filter of the cache, opening it on first use, or
+        None if disabled. This must be done before writing to the cache,
+        so no key is stored without being added to the filter.
+        """
+        if (self._bloom is None) and self.bloom_bits:
+            with self._lock(Flock.LOCK_EX):
+                bloom = BloomFilter(self.cachefile + ".bloom")
+                if bloom.open(self.bloom_bits) and self._read_header():
+                    # new filter beside an existing cache
+                    for obj in self._slots():
+                        bloom.add(obj.digest)
+                self._bloom = bloom
+        return self._bloom
+
     def get(self, date):
-        self._init_cache()
-        self._open("r+b")
+        if self._shards:
+            return sorted(
+                [obj for shard in self._shards for obj in shard.get(date)],
+                key=lambda x: x.creation,
+            )
 
-        with Flock(self.cachefd, Flock.LOCK_SH):
+        with self._lock(Flock.LOCK_SH):
             # return any new objects in the cache
-            return self._read(date)
+            newobjs = [obj for obj in self._read(date) if obj.trusted]
+            for obj in newobjs:
+                self._load(obj)
+            return newobjs
+
+    def lookup(self, key):
+        if self._shards:
+            return self._shard(key).lookup(key)
+
+        keydigest = digest(key)
+        bloom = self._filter()
+        if (bloom is not None) and (keydigest not in bloom):
+            # never stored, no need to lock and search the index
+            self._count("bloom_skips")
+            return None
+
+        with self._lock(Flock.LOCK_SH):
+            if not self._read_header():
+                return None
+            bucket, obj = self._find(keydigest)
+            if (obj is None) or obj.outdated(self.grace):
+                return None
+            if not obj.trusted:
+                # written with another serializer, treat as missing
+                return None
+            self._load(obj)
+            if obj.key != key:
+                # digest collision, the key is not stored
+                return None
+            return obj
+
+    @contextlib.contextmanager
+    def claim(self, key):
+        if self._shards:
+            with self._shard(key).claim(key) as waited:
+                yield waited
+            return
+        if not self.flight_timeout:
+            yield False
+            return
 
-    def put(self, key, value, lifetime):
         self._init_cache()
-        self._open("r+b")
+        with self._thread_lock:
+            if self._flightfd is None:
+                # claims are record locks over one byte per key digest of
+                # a file beside the cache, and are dropped with the process
+                self._flightfd = os.open(
+                    self.cachefile + ".flight", os.O_RDWR | os.O_CREAT
+                )
+        lock = RangeLock(self._flightfd, digest(key) % self._flight_range)
+        start = time.time()
+        acquired = lock.acquire()
+        waited = not acquired
+        while (not acquired) and (time.time() - start < self.flight_timeout):
+            # another process is fetching the key, wait for it to finish
+            time.sleep(0.05)
+            acquired = lock.acquire()
+        if waited:
+            self._time("flight_wait", time.time() - start)
+        try:
+            yield waited
+        finally:
+            if acquired:
+                lock.release()
 
-        with Flock(self.cachefd, Flock.LOCK_EX):
-            newobjs = self._read(self.age)
-            newobjs.append(FileCacheObject(key, value, lifetime))
+    def put(self, key, value, lifetime):
+        if self._shards:
+            return self._shard(key).put(key, value, lifetime)
+        return self._put([self._object(key, value, lifetime)])
 
-            # this will cause a new file object to be opened with the proper
-            # access mode, however the Flock should keep the old object open
-            # and properly locked
-            self._open("r+b")
-            self._write(newobjs)
-            return newobjs
+    def put_many(self, objects):
+        objects = list(objects)
+        if self._shards:
+            newobjs = []
+            for shard in self._shards:
+                objs = [
+                    obj for obj in objects if self._shard(obj.key) is shard
+                ]
+                if objs:
+                    newobjs.extend(shard.put_many(objs))
+            return sorted(newobjs, key=lambda x: x.creation)
+        return self._put(
+            [
+                self._object(obj.key, obj.data, obj.lifetime, obj.creation)
+                for obj in objects
+            ]
+        )
+
+    def _put(self, objs):
+        newobjs = self._store(objs)
+        if newobjs is None:
+            # out of free slots, compact to make room rather than
+            # rewriting the file while holding the exclusive lock
+            self.compact()
+            newobjs = self._store(objs, grow=True)
+
+        self._puts += len(objs)
+        if (
+            self.compact_ratio
+            and self.compact_interval
+            and (self._puts >= self.compact_interval)
+        ):
+            self._puts = 0
+            if self.dead_ratio() >= self.compact_ratio:
+                self.compact()
+        return newobjs
+
+    def _object(self, key, value, lifetime, creation=None):
+        obj = FileCacheObject(key, value, lifetime, creation)
+        obj.compress = self.compress
+        obj.serializer = self.serializer
+        return obj
+
+    def dump(self):
+        if self._shards:
+            return sorted(
+                [obj for shard in self._shards for obj in shard.dump()],
+                key=lambda x: x.creation,
+            )
+
+        with self._lock(Flock.LOCK_SH):
+            data = [obj for obj in self._live() if obj.trusted]
+            for obj in data:
+                self._load(obj)
+            return data
+
+    def restore(self, objects):
+        if self._shards:
+            objects = list(objects)
+            for shard in self._shards:
+                shard.restore(
+                    [obj for obj in objects if self._shard(obj.key) is shard]
+                )
+            return
+
+        data = [
+            self._object(obj.key, obj.data, obj.lifetime, obj.creation)
+            for obj in objects
+        ]
+        self._filter()
+        with self._lock(Flock.LOCK_EX):
+            # a single rewrite, merging with the live entries
+            self._write(data)
+            self.cachefd.flush()
+
+    def _store(self, objs, grow=False):
+        self._filter()
+        with self._lock(Flock.LOCK_EX):
+            valid = self._read_header()
+            if valid and (self.used + len(objs) <= self.size):
+                for obj in objs:
+                    self._append(obj)
+            elif valid and not grow:
+                return None
+            else:
+                # empty or outdated file, or compaction was not possible
+                self._write(objs)
+            self.cachefd.flush()
+            # report anything stored since the last call, including
+            # entries written by other processes
+            return self._read(self.age)
 
     def _open(self, mode="r+b"):
         # enforce binary operation
         try:
-            if self.cachefd.mode == mode:
+            if self.cachefd.mode == mode and not self.cachefd.closed:
                 # already opened in requested mode, nothing to do
                 self.cachefd.seek(0)
                 return
@@ -305,105 +868,280 @@ class FileEngine(CacheEngine):
             pass  # catch issue of no cachefile yet opened
         self.cachefd = io.open(self.cachefile, mode)
 
-    def _read(self, date):
+    def _read_header(self):
         try:
             self.cachefd.seek(0)
-            version, count = self._struct.unpack(
-                self.cachefd.read(self._struct.size)
+            version, flags, size, used, buckets = self._struct.unpack(
+                self._pread(0, self._struct.size)
             )
-            if version != self._version:
-                # old version, break out and well rewrite when finished
-                raise Exception
-
-            self.size = count
-            cache = []
-            while count:
-                # loop through storage definitions
-                obj = FileCacheObject.fromFile(self.cachefd)
-                cache.append(obj)
-                count -= 1
-
         except:
-            # failed to read information, so just discard it and return empty
-            self.size = 0
-            self.free = 0
-            return []
+            version = None
+        if version != self._version:
+            # old version or empty file, will be rewritten on next put
+            self.size = self.used = self.buckets = 0
+            return False
+        self.size, self.used, self.buckets = size, used, buckets
+        return True
 
-        # get end of file
-        self.cachefd.seek(0, 2)
-        position = self.cachefd.tell()
+    def _slot_offset(self, slot):
+        return (
+            self._struct.size
+            + self._bucket.size * self.buckets
+            + FileCacheObject._struct.size * slot
+        )
+
+    def _read_slot(self, slot):
+        obj = FileCacheObject.fromBytes(
+            self._pread(self._slot_offset(slot), FileCacheObject._struct.size)
+        )
+        obj.slot = slot
+        obj.serializer = self.serializer
+        return obj
+
+    def _find(self, keydigest):
+        """
+        Walk the index from the bucket for the given digest, returning the
+        position of the bucket holding that digest, or of the empty bucket
+        it would be stored in, along with the stored object if any.
+        """
+        start = keydigest % self.buckets
+        for i in range(self.buckets):
+            bucket = (start + i) % self.buckets
+            slot = self._bucket.unpack(
+                self._pread(
+                    self._struct.size + self._bucket.size * bucket,
+                    self._bucket.size,
+                )
+            )[0]
+            if slot == 0:
+                return bucket, None
+            obj = self._read_slot(slot - 1)
+            if obj.digest == keydigest:
+                return bucket, obj
+        raise TMDBCacheError("Cache file index is full.")
+
+    def _read(self, date):
+        """
+        Return the headers of any live objects newer than date, walking
+        backward from the most recently filled slot.
+        """
+        if not self._read_header():
+            return []
         newobjs = []
-        emptycount = 0
-
-        # walk backward through all, collecting new content and populating size
-        while len(cache):
-            obj = cache.pop()
-            if obj.creation == 0:
-                # unused slot, skip
-                emptycount += 1
-            elif obj.expired:
-                # object has passed expiration date, no sense processing
-                continue
-            elif obj.creation > date:
-                # used slot with new data, process
-                obj.size, position = position - obj.position, obj.position
+        for slot in range(self.used - 1, -1, -1):
+            obj = self._read_slot(slot)
+            if obj.creation <= date:
+                # end of new data, break
+                break
+            if not obj.expired:
                 newobjs.append(obj)
                 # update age
                 self.age = max(self.age, obj.creation)
-            elif len(newobjs):
-                # end of new data, break
-                break
+        newobjs.reverse()
+        return newobjs
 
-        # walk forward and load new content
-        for obj in newobjs:
-            obj.load(self.cachefd)
+    def _slots(self):
+        """Return the headers of all filled slots, read in a single pass."""
+        fd = io.BytesIO(
+            self._pread(
+                self._slot_offset(0), FileCacheObject._struct.size * self.used
+            )
+        )
+        slots = []
+        for slot in range(self.used):
+            obj = FileCacheObject.fromFile(fd)
+            obj.slot = slot
+            obj.serializer = self.serializer
+            slots.append(obj)
+        return slots
 
-        self.free = emptycount
-        return newobjs
+    def _live(self, slots=None):
+        """
+        Return the headers of all live objects in the file, skipping any
+        replaced by a later slot for the same key.
+        """
+        if slots is None:
+            if not self._read_header():
+                return []
+            slots = self._slots()
+        objs = {}
+        for obj in slots:
+            objs[obj.digest] = obj
+        return sorted(
+            [obj for obj in objs.values() if not obj.outdated(self.grace)],
+            key=lambda x: x.creation,
+        )
+
+    def dead_ratio(self):
+        """
+        Return the fraction of stored data belonging to expired or
+        replaced entries, that a compaction would reclaim. For a sharded
+        cache, this is the ratio of the worst shard.
+        """
+        if self._shards:
+            return max(shard.dead_ratio() for shard in self._shards)
+
+        with self._lock(Flock.LOCK_SH):
+            if not self._read_header():
+                return 0
+            slots = self._slots()
+            total = sum(obj.size for obj in slots)
+            if not total:
+                return 0
+            live = sum(obj.size for obj in self._live(slots))
+            return 1 - float(live) / total
+
+    def compact(self):
+        """
+        Rewrite the cache file without expired or replaced entries. The new
+        file is written alongside and moved in place once complete, so
+        readers are not blocked while it is built. Returns False if the
+        compaction could not be performed, or another was in progress.
+        """
+        if self._shards:
+            return all([shard.compact() for shard in self._shards])
+
+        self._init_cache()
+        with io.open(self.cachefile + ".lock", "a+b") as lockfd:
+            lock = Flock(lockfd, Flock.LOCK_EX_NB)
+            try:
+                lock.__enter__()
+            except (IOError, OSError):
+                # another compaction is already in progress
+                return False
+            try:
+                return self._compact()
+            finally:
+                lock.__exit__(None, None, None)
+
+    def _compact(self):
+        tmpname = "{0}.{1}.tmp".format(self.cachefile, os.getpid())
+        # shared lock keeps out writers, while letting readers through
+        with self._lock(Flock.LOCK_SH):
+            data = self._live()
+            try:
+                with io.open(tmpname, "w+b") as fd:
+                    self._dump(fd, data)
+                if self._bloom is not None:
+                    # drop keys no longer stored, while the lock on the
+                    # only live file keeps writers out. once replaced,
+                    # they may write to the new file
+                    self._bloom.reset(d.digest for d in data)
+                os.replace(tmpname, self.cachefile)
+            except (IOError, OSError):
+                # cannot replace an open file on some platforms
+                if os.path.exists(tmpname):
+                    os.remove(tmpname)
+                return False
+        return True
+
+    def _append(self, obj):
+        # write data to the end of the file
+        self.cachefd.seek(0, 2)
+        obj.position = self.cachefd.tell()
+        obj.dumpdata(self.cachefd)
+        self._count("bytes_written", obj.size)
+
+        if self._bloom is not None:
+            self._bloom.add(obj.digest)
+
+        # fill the next free slot, and point the index at it
+        bucket, old = self._find(obj.digest)
+        self.cachefd.seek(self._slot_offset(self.used))
+        obj.dumpslot(self.cachefd)
+        self.used += 1
+        self.cachefd.seek(self._struct.size + self._bucket.size * bucket)
+        self.cachefd.write(self._bucket.pack(self.used))
+        self._write_header(self.cachefd)
+
+    def _write_header(self, fd):
+        fd.seek(0)
+        fd.write(
+            self._struct.pack(
+                self._version, 0, self.size, self.used, self.buckets
+            )
+        )
 
     def _write(self, data):
-        if self.free and (self.size != self.free):
-            # we only care about the last data point, since the rest are
-            # already stored in the file
-            data = data[-1]
-
-            # determine write position of data in cache
-            self.cachefd.seek(0, 2)
-            end = self.cachefd.tell()
-            data.position = end
-
-            # write incremental update to free slot
-            self.cachefd.seek(4 + 16 * (self.size - self.free))
-            data.dumpslot(self.cachefd)
-            data.dumpdata(self.cachefd)
-
-        else:
-            # rewrite cache file from scratch
-            # pull data from parent cache
-            data.extend(list(self.parent()._data.values()))
-            data.sort(key=lambda x: x.creation)
-            # write header
-            size = len(data) + self.preallocate
-            self.cachefd.seek(0)
-            self.cachefd.truncate()
-            self.cachefd.write(self._struct.pack(self._version, size))
-            # write storage slot definitions
-            prev = None
+        # rewrite cache file from scratch in place, keeping any live entries
+        live = self._live()
+        for d in live:
+            self._load(d)
+        # drop the mapping before truncating, to not read past the new end
+        self._unmap()
+        self.cachefd.seek(0)
+        self.cachefd.truncate()
+        self._dump(self.cachefd, live + data)
+        if self._bloom is not None:
             for d in data:
-                if prev is None:
-                    d.position = 4 + 16 * size
-                else:
-                    d.position = prev.position + prev.size
-                d.dumpslot(self.cachefd)
-                prev = d
-            # fill in allocated slots
-            for i in range(2 ** 8):
-                self.cachefd.write(FileCacheObject._struct.pack(0, 0, 0))
-            # write stored data
-            for d in data:
-                d.dumpdata(self.cachefd)
+                self._bloom.add(d.digest)
 
-        self.cachefd.flush()
+    def _dump(self, fd, data):
+        """
+        Write a complete cache file containing the given objects, with
+        later objects replacing earlier ones for the same key. Data not
+        already loaded is copied over from the current cache file.
+        """
+        data = sorted(data, key=lambda x: x.creation)
+        data = sorted(
+            dict((d.digest, d) for d in data).values(),
+            key=lambda x: x.creation,
+        )
+        positions = [d.position for d in data]
+
+        # free slots grow with the file, so a cache filling up is
+        # rewritten geometrically less often
+        free = max(self.preallocate, len(data) // 2)
+        self.size = len(data) + free
+        self.used = len(data)
+        self.buckets = 2 * self.size
+
+        # build index
+        index = [0] * self.buckets
+        for slot, d in enumerate(data):
+            bucket = d.digest % self.buckets
+            while index[bucket]:
+                bucket = (bucket + 1) % self.buckets
+            index[bucket] = slot + 1
+
+        # write header and index
+        self._write_header(fd)
+        fd.write(b"".join(self._bucket.pack(i) for i in index))
+        # write storage slot definitions
+        position = self._slot_offset(self.size)
+        for d in data:
+            d.position = position
+            position += d.size
+            d.dumpslot(fd)
+        # fill in allocated slots
+        fd.write(
+            FileCacheObject._struct.pack(0, 0, 0, 0, 0, 0) * free
+        )
+        # write stored data
+        for d, position in zip(data, positions):
+            if d._buff is None:
+                self._load(d, position)
+                d.dumpdata(fd)
+                d._buff = None
+            else:
+                d.dumpdata(fd)
+        # entries copied by compactions and rewrites count as written too
+        self._count("bytes_written", sum(d.size for d in data))
+
+        fd.flush()
 
     def expire(self, key):
-        pass
+        if self._shards:
+            return self._shard(key).expire(key)
+
+        with self._lock(Flock.LOCK_EX):
+            if not self._read_header():
+                return
+            bucket, obj = self._find(digest(key))
+            if obj is None:
+                return
+            # a lifetime of zero marks the slot as expired
+            self.cachefd.seek(self._slot_offset(obj.slot))
+            obj.lifetime = 0
+            obj.dumpslot(self.cachefd)
+            self.cachefd.flush()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -----------------------
+# Name: cache_memory.py
+# Python Library
+# Purpose: Non-persistent in-process cache, bounded in size by evicting
+#          the least recently used entries.
+# -----------------------
+
+from collections import OrderedDict
+import threading
+import json
+
+from .cache_engine import CacheEngine, CacheObject
+
+
+class MemoryEngine(CacheEngine):
+    """In-process engine with least recently used eviction."""
+
+    name = "memory"
+    indexed = True
+
+    def __init__(self, parent):
+        super(MemoryEngine, self).__init__(parent)
+        self._lock = threading.RLock()
+        self.configure()
+
+    def configure(self, max_bytes=32 * 1024 * 1024, max_entries=None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.size = 0
+        self._data = OrderedDict()
+
+    def _evict(self):
+        # drop from the least recently used end until within budget
+        while self._data and (
+            (self.max_bytes is not None and self.size > self.max_bytes)
+            or (
+                self.max_entries is not None
+                and len(self._data) > self.max_entries
+            )
+        ):
+            key, (obj, size) = self._data.popitem(last=False)
+            self.size -= size
+
+    def _discard(self, key):
+        obj, size = self._data.pop(key, (None, 0))
+        self.size -= size
+
+    def get(self, date):
+        with self._lock:
+            return [
+                obj
+                for obj, size in self._data.values()
+                if (obj.creation > date) and not obj.expired
+            ]
+
+    def lookup(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            obj, size = self._data[key]
+            if obj.outdated(self.grace):
+                self._discard(key)
+                return None
+            self._data.move_to_end(key)
+            return obj
+
+    def put(self, key, value, lifetime):
+        obj = CacheObject(key, value, lifetime)
+        self.add(obj)
+        return [obj]
+
+    def put_many(self, objects):
+        objects = list(objects)
+        with self._lock:
+            for obj in objects:
+                self.add(obj)
+        return objects
+
+    def add(self, obj):
+        """Store an existing cache object, retaining its creation time."""
+        # size is approximated by the length of the JSON encoding, and
+        # only computed when there is a byte budget to enforce
+        size = 0 if self.max_bytes is None else len(json.dumps(obj.data))
+        with self._lock:
+            self._discard(obj.key)
+            self._data[obj.key] = (obj, size)
+            self.size += size
+            self._evict()
+
+    def restore(self, objects):
+        with self._lock:
+            for obj in objects:
+                if obj.outdated(self.grace):
+                    continue
+                if obj.key in self._data:
+                    current, size = self._data[obj.key]
+                    if current.creation >= obj.creation:
+                        continue
+                self.add(obj)
+
+    def expire(self, key):
+        with self._lock:
+            self._discard(key)
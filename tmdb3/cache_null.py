@@ -26,3 +26,6 @@ class NullEngine(CacheEngine):
 
     def expire(self, key):
         pass
+
+    def restore(self, objects):
+        pass
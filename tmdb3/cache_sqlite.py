@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -----------------------
+# Name: cache_sqlite.py
+# Python Library
+# Purpose: Persistent SQLite-backed cache, keyed by request URL, allowing
+#          indexed lookups and concurrent access from several processes
+#          through the write-ahead log.
+# -----------------------
+
+import threading
+import sqlite3
+import json
+import time
+import os
+
+from .tmdb_exceptions import *
+from .cache_engine import CacheEngine, CacheObject
+from .cache_file import parse_filename
+
+####################
+# Cache Table Layout
+# ------------------
+# key                   TEXT primary key, the request URL
+# data                  TEXT JSON encoded response
+# lifetime              INTEGER seconds after creation before expiring
+# creation              REAL timestamp the response was stored
+#
+# Lookups of a single key go through the primary key index, while the
+# (creation, lifetime) index serves incremental reads of new entries and
+# purging of expired ones.
+####################
+
+
+class SQLiteEngine(CacheEngine):
+    """SQLite-backed engine with indexed key lookup."""
+
+    name = "sqlite"
+    indexed = True
+
+    def __init__(self, parent):
+        super(SQLiteEngine, self).__init__(parent)
+        self._lock = threading.RLock()
+        self._conn = None
+        self._pid = None
+        self.configure(None)
+
+    def configure(self, filename, timeout=30, purge=256):
+        self.cachefile = filename
+        self.timeout = timeout
+        self.purge = purge
+        self.age = 0
+        self._puts = 0
+        if (self._conn is not None) and (self._pid == os.getpid()):
+            self._conn.close()
+        self._conn = None
+
+    def _init_cache(self):
+        if self._conn is not None:
+            if self._pid == os.getpid():
+                return
+            # connection inherited across a fork, which SQLite does not
+            # allow using, nor closing, from the child
+            self._conn = None
+
+        if self.cachefile is None:
+            raise TMDBCacheError("No cache filename given.")
+        self.cachefile = parse_filename(self.cachefile)
+
+        if os.path.exists(self.cachefile):
+            if not os.access(self.cachefile, os.R_OK):
+                # file exists, but we do not have permission to access it
+                raise TMDBCacheReadError(self.cachefile)
+            if not os.access(self.cachefile, os.W_OK):
+                raise TMDBCacheWriteError(self.cachefile)
+        else:
+            directory = os.path.dirname(self.cachefile) or "."
+            if not os.path.isdir(directory):
+                raise TMDBCacheDirectoryError(self.cachefile)
+            if not os.access(directory, os.W_OK):
+                # user does not have rights to create new file
+                raise TMDBCacheWriteError(self.cachefile)
+
+        conn = sqlite3.connect(
+            self.cachefile,
+            timeout=self.timeout,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        # WAL allows readers in other processes to proceed while a single
+        # writer appends new entries
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, "
+            "data TEXT NOT NULL, "
+            "lifetime INTEGER NOT NULL, "
+            "creation REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS cache_creation "
+            "ON cache (creation, lifetime)"
+        )
+        self._conn = conn
+        self._pid = os.getpid()
+
+    def get(self, date):
+        with self._lock:
+            self._init_cache()
+            rows = self._conn.execute(
+                "SELECT key, data, lifetime, creation FROM cache "
+                "WHERE creation > ? AND creation + lifetime > ? "
+                "ORDER BY creation",
+                (date, time.time()),
+            ).fetchall()
+
+        newobjs = []
+        for key, data, lifetime, creation in rows:
+            self._count("bytes_read", len(data))
+            obj = CacheObject(key, json.loads(data), lifetime, creation)
+            newobjs.append(obj)
+            self.age = max(self.age, creation)
+        return newobjs
+
+    def lookup(self, key):
+        with self._lock:
+            self._init_cache()
+            row = self._conn.execute(
+                "SELECT data, lifetime, creation FROM cache WHERE key = ?",
+                (key,),
+            ).fetchone()
+
+        if row is None:
+            return None
+        obj = CacheObject(key, None, row[1], row[2])
+        if obj.outdated(self.grace):
+            return None
+        obj.data = json.loads(row[0])
+        self._count("bytes_read", len(row[0]))
+        return obj
+
+    def put(self, key, value, lifetime):
+        obj = CacheObject(key, value, lifetime)
+        data = json.dumps(value)
+        with self._lock:
+            self._init_cache()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, data, lifetime, creation) "
+                "VALUES (?, ?, ?, ?)",
+                (key, data, lifetime, obj.creation),
+            )
+            self._count("bytes_written", len(data))
+            self._puts += 1
+            if self.purge and not (self._puts % self.purge):
+                self._purge()
+        self.age = max(self.age, obj.creation)
+        return [obj]
+
+    def put_many(self, objects):
+        objects = list(objects)
+        rows = [
+            (obj.key, json.dumps(obj.data), obj.lifetime, obj.creation)
+            for obj in objects
+        ]
+        with self._lock:
+            self._init_cache()
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO cache "
+                    "(key, data, lifetime, creation) VALUES (?, ?, ?, ?)",
+                    rows,
+                )
+            except:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            self._count("bytes_written", sum(len(r[1]) for r in rows))
+            self._puts += len(rows)
+            if self.purge and (self._puts >= self.purge):
+                self._puts = 0
+                self._purge()
+        for obj in objects:
+            self.age = max(self.age, obj.creation)
+        return objects
+
+    def _purge(self):
+        # drop expired entries, rather than let the table grow forever
+        self._conn.execute(
+            "DELETE FROM cache WHERE creation + lifetime <= ?",
+            (time.time() - self.grace,),
+        )
+
+    def restore(self, objects):
+        rows = [
+            (obj.key, json.dumps(obj.data), obj.lifetime, obj.creation)
+            for obj in objects
+        ]
+        with self._lock:
+            self._init_cache()
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO cache "
+                    "(key, data, lifetime, creation) VALUES (?, ?, ?, ?)",
+                    rows,
+                )
+                # replace existing entries only by newer ones
+                self._conn.executemany(
+                    "UPDATE cache SET data = ?, lifetime = ?, creation = ? "
+                    "WHERE key = ? AND creation < ?",
+                    [(r[1], r[2], r[3], r[0], r[3]) for r in rows],
+                )
+            except:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def expire(self, key):
+        with self._lock:
+            self._init_cache()
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -----------------------
+# Name: cache_stats.py
+# Python Library
+# Purpose: Counters and timing histograms collected by the cache, to tell
+#          apart time spent on the network, waiting for file locks, and
+#          sleeping for rate limiting.
+# -----------------------
+
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+import threading
+import time
+
+
+def endpoint(key):
+    """
+    Reduce a cache key to the API endpoint it belongs to, dropping the
+    query string and replacing numeric ids, e.g. 'movie/{id}/images'.
+    """
+    path = urlsplit(key).path.strip("/").split("/")
+    if path and path[0] == "3":
+        # strip API version
+        path = path[1:]
+    return "/".join("{id}" if p.isdigit() else p for p in path)
+
+
+class Timer(object):
+    """Histogram of durations, in seconds."""
+
+    # upper bounds of the histogram buckets, the last one is unbounded
+    bounds = (0.001, 0.01, 0.1, 1, 10)
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(self.bounds) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        for i, bound in enumerate(self.bounds):
+            if seconds <= bound:
+                break
+        else:
+            i = len(self.bounds)
+        self.buckets[i] += 1
+
+    def asdict(self):
+        labels = ["<={0}".format(b) for b in self.bounds]
+        labels.append(">{0}".format(self.bounds[-1]))
+        return {
+            "count": self.count,
+            "total": self.total,
+            "max": self.max,
+            "buckets": dict(zip(labels, self.buckets)),
+        }
+
+
+class CacheStats(object):
+    """
+    Metrics collected by a Cache and its engine. Counters are plain
+    integers, such as bytes read and written, while timers hold a
+    histogram of durations, such as the time spent waiting for locks.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.timers = {}
+            self.endpoints = {}
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def time(self, name, seconds):
+        with self._lock:
+            if name not in self.timers:
+                self.timers[name] = Timer()
+            self.timers[name].add(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.time(name, time.time() - start)
+
+    def lookup(self, key, hit):
+        """Record a hit or miss for the endpoint of a cache key."""
+        name = endpoint(key)
+        with self._lock:
+            counts = self.endpoints.setdefault(name, {"hits": 0, "misses": 0})
+            counts["hits" if hit else "misses"] += 1
+
+    def asdict(self):
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "timers": {k: v.asdict() for k, v in self.timers.items()},
+                "endpoints": {k: dict(v) for k, v in self.endpoints.items()},
+            }
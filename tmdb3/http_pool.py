@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -----------------------
+# Name: http_pool.py
+# Python Library
+# Purpose: Pool of persistent HTTP connections, reused between requests to
+#          save a TCP and TLS handshake per request.
+# -----------------------
+
+import urllib.request
+import urllib.response
+import urllib.error
+import urllib.parse
+import http.client
+import threading
+import time
+import io
+import os
+
+
+class ConnectionPool(object):
+    """
+    Keeps up to `maxsize` idle connections per host open for reuse, closing
+    those left idle for longer than `idle_timeout` seconds. Responses are
+    read whole before the connection is returned, so they are handed back
+    as in-memory file objects, like those from urllib.request.urlopen().
+    """
+
+    # redirections followed before giving up, as urllib does
+    max_redirects = 10
+    # errors showing an idle connection was closed by the server before
+    # answering, after which the request is sent once more
+    stale_errors = (
+        http.client.RemoteDisconnected,
+        http.client.BadStatusLine,
+        BrokenPipeError,
+        ConnectionResetError,
+    )
+
+    def __init__(self, maxsize=4, idle_timeout=60, timeout=30):
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._pid = os.getpid()
+        self.configure(maxsize, idle_timeout, timeout)
+
+    def configure(self, maxsize=4, idle_timeout=60, timeout=30):
+        """Set the pool size, idle timeout and socket timeout."""
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.clear()
+
+    def clear(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn, used in conns:
+                conn.close()
+
+    def _check_pid(self):
+        """Forget connections inherited across a fork, without using them."""
+        if self._pid != os.getpid():
+            # the parent still owns the sockets, closing them here could
+            # shut down its connections
+            self._idle = {}
+            self._pid = os.getpid()
+
+    def _get(self, host):
+        """Return an idle connection to host, or a new one, and if reused."""
+        now = time.monotonic()
+        with self._lock:
+            self._check_pid()
+            conns = self._idle.get(host, [])
+            while conns:
+                conn, used = conns.pop()
+                if now - used <= self.idle_timeout:
+                    return conn, True
+                conn.close()
+        scheme, netloc = host
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+        return conn, False
+
+    def _put(self, host, conn):
+        with self._lock:
+            self._check_pid()
+            conns = self._idle.setdefault(host, [])
+            if len(conns) < self.maxsize:
+                conns.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def urlopen(self, request):
+        """
+        Send a urllib.request.Request, returning the response, or raising
+        urllib.error.HTTPError for error statuses. Requests through a proxy
+        are left to urllib.request.urlopen().
+        """
+        url = request.get_full_url()
+        method = request.get_method()
+        data = request.data
+        headers = dict(request.header_items())
+        for redirect in range(self.max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            if (parts.scheme in urllib.request.getproxies()) and not (
+                urllib.request.proxy_bypass(parts.hostname)
+            ):
+                return urllib.request.urlopen(request)
+
+            status, reason, response, body = self._send(
+                method, data, headers, parts
+            )
+            if status in (301, 302, 303, 307, 308) and (
+                "Location" in response
+            ):
+                url = urllib.parse.urljoin(url, response["Location"])
+                if ((status == 303) and (method != "HEAD")) or (
+                    (status in (301, 302)) and (method == "POST")
+                ):
+                    # follow with a GET without the body, as urllib does
+                    method, data = "GET", None
+                    headers = {
+                        k: v
+                        for k, v in headers.items()
+                        if k.lower() not in ("content-length", "content-type")
+                    }
+                continue
+            if status >= 400:
+                raise urllib.error.HTTPError(
+                    url, status, reason, response, io.BytesIO(body)
+                )
+            return urllib.response.addinfourl(
+                io.BytesIO(body), response, url, status
+            )
+        raise urllib.error.HTTPError(
+            url, status, "Too many redirections", response, io.BytesIO(body)
+        )
+
+    def _send(self, method, data, headers, parts):
+        host = (parts.scheme, parts.netloc)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        headers = dict(headers)
+        headers.setdefault("Connection", "keep-alive")
+
+        retried = False
+        while True:
+            conn, reused = self._get(host)
+            try:
+                conn.request(method, path, data, headers)
+                response = conn.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                if reused and not retried and isinstance(e, self.stale_errors):
+                    # the server closed the idle connection, try another
+                    retried = True
+                    continue
+                raise urllib.error.URLError(e)
+            break
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._put(host, conn)
+        return response.status, response.reason, response.msg, body
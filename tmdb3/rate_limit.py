@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -----------------------
+# Name: rate_limit.py
+# Python Library
+# Purpose: Sliding window limiting the rate of requests sent to the TMDb
+#          API, independently of the cache, optionally kept in a file shared
+#          by several processes.
+# -----------------------
+
+from collections import deque
+import threading
+import struct
+import time
+import io
+import os
+
+from .cache_file import Flock, parse_filename
+
+
+class RateLimiter(object):
+    """
+    Sliding window allowing `burst` requests within any window of
+    `burst / rate` seconds, kept as a deque of the last `burst` send times.
+    Callers over the limit reserve the next free send time and sleep until
+    it is due, so they are served in order.
+    """
+
+    def __init__(self, rate=3, burst=30):
+        self._lock = threading.Lock()
+        self.configure(rate, burst)
+
+    def configure(self, rate=3, burst=30):
+        """Set the rate and burst, a rate of zero disables limiting."""
+        with self._lock:
+            self.rate = rate
+            self.burst = burst
+            self.sent = deque(maxlen=max(int(burst), 1))
+
+    @property
+    def window(self):
+        """Seconds within which up to `burst` requests are sent."""
+        return self.burst / float(self.rate)
+
+    def acquire(self):
+        """Take the next send time, waiting for it if needed."""
+        with self._lock:
+            if not self.rate:
+                return 0
+            wait = self._update(self._reserve)
+        if wait > 0:
+            time.sleep(wait)
+            return wait
+        return 0
+
+    def pause(self, seconds):
+        """Hold back any further requests for the given time."""
+        with self._lock:
+            if self.rate:
+                self._update(
+                    lambda sent, now: self._hold(sent, now + seconds)
+                )
+
+    def sync(self, remaining, reset=None):
+        """
+        Follow the number of requests the server reports remain allowed,
+        and if there are none, the time it will allow more from. Send times
+        already reserved by waiting callers are kept.
+        """
+        if (remaining <= 0) and (reset is not None):
+            self.pause(reset - time.time())
+            return
+        with self._lock:
+            if self.rate:
+                self._update(
+                    lambda sent, now: self._allow(sent, now, remaining)
+                )
+
+    def _update(self, func):
+        """Return func(sent, now), given the send times of the window."""
+        return func(self.sent, time.monotonic())
+
+    def _reserve(self, sent, now):
+        """Take the next free send time, returning the wait until it."""
+        due = now
+        if sent:
+            # after any earlier reservation
+            due = max(due, sent[-1])
+        if len(sent) >= self.burst:
+            due = max(due, sent[0] + self.window)
+        sent.append(due)
+        return due - now
+
+    def _hold(self, sent, until):
+        # fill the window so the next send time is due no earlier than until
+        start = until - self.window
+        times = [max(t, start) for t in sent]
+        sent.clear()
+        sent.extend([start] * (sent.maxlen - len(times)) + times)
+
+    def _allow(self, sent, now, remaining):
+        remaining = max(min(remaining, self.burst), 0)
+        # requests that may be sent right away
+        allowed = self.burst - sum(1 for t in sent if t > now - self.window)
+        while sent and (sent[0] <= now) and (allowed < remaining):
+            # forget past sends the server no longer counts
+            if sent.popleft() > now - self.window:
+                allowed += 1
+        if allowed > remaining:
+            # count sends the server saw from elsewhere
+            times = sorted(list(sent) + [now] * (allowed - remaining))
+            sent.clear()
+            sent.extend(times)
+
+
+class SharedRateLimiter(RateLimiter):
+    """
+    Sliding window kept in a file, drawn from by every process using the
+    same file, so they share one budget. All of them should be given the
+    same rate and burst.
+    """
+
+    _struct = struct.Struct("<d")  # send time, repeated
+
+    def __init__(self, filename, rate=3, burst=30):
+        self.filename = parse_filename(filename)
+        self._fd = None
+        self._pid = None
+        super(SharedRateLimiter, self).__init__(rate, burst)
+
+    def configure(self, rate=3, burst=30):
+        """Set the rate and burst, leaving the shared state as it is."""
+        with self._lock:
+            self.rate = rate
+            self.burst = burst
+
+    def _update(self, func):
+        if (self._fd is not None) and (self._pid != os.getpid()):
+            # inherited across a fork, sharing the open file, its offset and
+            # its flock with the parent, which would not exclude each other
+            self._fd.close()
+            self._fd = None
+        if self._fd is None:
+            self._fd = io.open(
+                os.open(self.filename, os.O_RDWR | os.O_CREAT), "r+b", 0
+            )
+            self._pid = os.getpid()
+        with Flock(self._fd, Flock.LOCK_EX):
+            self._fd.seek(0)
+            data = self._fd.read()
+            count = len(data) // self._struct.size
+            times = self._struct.iter_unpack(data[:count * self._struct.size])
+            sent = deque((t for t, in times), maxlen=max(int(self.burst), 1))
+            # wall clock time, as monotonic clocks differ between processes
+            result = func(sent, time.time())
+            self._fd.seek(0)
+            self._fd.truncate()
+            self._fd.write(b"".join(self._struct.pack(t) for t in sent))
+        return result
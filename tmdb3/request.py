@@ -11,14 +11,28 @@
 from .tmdb_exceptions import *
 from .locales import get_locale
 from .cache import Cache
+from .rate_limit import RateLimiter, SharedRateLimiter
+from .http_pool import ConnectionPool
 
 import urllib.request
+import urllib.response
 import urllib.error
 import urllib.parse
+import email.utils
+import hashlib
 import json
+import gzip
+import time
+import zlib
+import re
+import io
 
 DEBUG = False
 cache = Cache(filename="pytmdb3.cache")
+# API requests are limited to 30 within 10 seconds
+limiter = RateLimiter(rate=3, burst=30)
+# connections to the API are kept open for reuse
+pool = ConnectionPool()
 
 # DEBUG = True
 # cache = Cache(engine='null')
@@ -43,9 +57,121 @@ def set_cache(engine=None, *args, **kwargs):
     cache.configure(engine, *args, **kwargs)
 
 
+def set_rate_limit(rate, burst, filename=None):
+    """
+    Specify how many requests per second may be sent to themoviedb.org,
+    as up to `burst` requests within any `burst / rate` seconds. A rate
+    of zero disables the limit. Processes given the same `filename` share
+    a single limit.
+    """
+    global limiter
+    if filename is None:
+        limiter = RateLimiter(rate, burst)
+    else:
+        limiter = SharedRateLimiter(filename, rate, burst)
+
+
+# lifetime in seconds of cached responses, by API path. patterns are
+# matched in order against the whole path, with {id} matching a numeric
+# path component and * matching anything.
+lifetimes = [
+    ("configuration", 60 * 60 * 24 * 7),  # 1wk
+    ("genre/list", 60 * 60 * 24 * 7),
+    ("genre/*/list", 60 * 60 * 24 * 7),
+    ("account", 60 * 5),  # 5min
+    ("account/*", 60 * 5),
+    ("search/*", 60 * 15),  # 15min
+    ("discover/*", 60 * 15),
+    ("movie/{id}", 60 * 60 * 12),  # 12hr
+    ("tv/{id}", 60 * 60 * 12),
+    ("person/{id}", 60 * 60 * 12),
+    ("*", 60 * 60),  # 1hr
+]
+_lifetime_patterns = {}
+
+
+def set_lifetime(pattern, lifetime):
+    """
+    Specify the lifetime in seconds of cached responses for API paths
+    matching the given pattern, taking precedence over any existing
+    patterns. A lifetime of zero disables caching for those paths.
+    """
+    lifetimes[:] = [(p, l) for p, l in lifetimes if p != pattern]
+    lifetimes.insert(0, (pattern, lifetime))
+
+
+def get_lifetime(url):
+    """Return the lifetime of cached responses for the given API path."""
+    for pattern, lifetime in lifetimes:
+        if pattern not in _lifetime_patterns:
+            regex = ".*".join(
+                "[0-9]+".join(re.escape(p) for p in part.split("{id}"))
+                for part in pattern.split("*")
+            )
+            _lifetime_patterns[pattern] = re.compile(regex + "$")
+        if _lifetime_patterns[pattern].match(url):
+            return lifetime
+    return 60 * 60
+
+
+def retry_after(headers, default=1):
+    """
+    Return the seconds to wait given by a Retry-After header, which holds
+    either a number of seconds or a date.
+    """
+    value = headers.get("Retry-After")
+    if value is None:
+        return default
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    return max(date.timestamp() - time.time(), 0)
+
+
+def throttle(headers):
+    """Pass any rate limit reported in response headers to the limiter."""
+    remaining = headers.get("X-RateLimit-Remaining")
+    if remaining is None:
+        return
+    reset = headers.get("X-RateLimit-Reset")
+    try:
+        limiter.sync(int(remaining), None if reset is None else float(reset))
+    except ValueError:
+        pass
+
+
+def decode(fp, headers):
+    """
+    Return a file object reading the response body from fp, decompressed
+    according to its Content-Encoding header.
+    """
+    encoding = headers.get("Content-Encoding", "").strip().lower()
+    if encoding in ("gzip", "x-gzip"):
+        # decompressed as it is read
+        return gzip.GzipFile(fileobj=fp)
+    if encoding == "deflate":
+        data = fp.read()
+        try:
+            return io.BytesIO(zlib.decompress(data))
+        except zlib.error:
+            # raw deflate stream, without the zlib header
+            return io.BytesIO(zlib.decompress(data, -zlib.MAX_WBITS))
+    return fp
+
+
 class Request(urllib.request.Request):
     _api_key = None
     _base_url = "http://api.themoviedb.org/3/"
+    # times a request is sent again after the server responds with HTTP 429
+    retries = 3
+    # lifetime of cached responses for invalid ids and missing resources,
+    # which are raised again from the cache rather than queried each time
+    negative_lifetime = 300  # 5min
 
     @property
     def api_key(self):
@@ -82,11 +208,13 @@ class Request(urllib.request.Request):
                     break
 
             kwargs[formatted_key] = locale.encode(v)
+        self._params = kwargs
         url = f"{self._base_url}{self._url}?{urllib.parse.urlencode(kwargs)}"
 
         urllib.request.Request.__init__(self, url)
         self.add_header("Accept", "application/json")
-        self.lifetime = 3600  # 1hr
+        self.add_header("Accept-Encoding", "gzip, deflate")
+        self.lifetime = get_lifetime(self._url)
 
     def new(self, **kwargs):
         """
@@ -103,28 +231,105 @@ class Request(urllib.request.Request):
         obj.lifetime = self.lifetime
         return obj
 
+    def cache_key(self):
+        """
+        Return the key responses are cached under, independent of the
+        order of the query parameters and of the API key, so requests for
+        the same data share a cache entry. Session ids are hashed, keeping
+        responses of different sessions apart without storing the ids.
+        """
+        params = []
+        for k, v in sorted(self._params.items()):
+            if k == "api_key":
+                continue
+            if k == "session_id":
+                if isinstance(v, str):
+                    v = v.encode("utf-8")
+                v = hashlib.sha256(v).hexdigest()[:16]
+            params.append((k, v))
+        if not params:
+            return self._url
+        return f"{self._url}?{urllib.parse.urlencode(params)}"
+
     def add_data(self, data):
         """Provide data to be sent with POST."""
         urllib.request.Request.data = self, urllib.parse.urlencode(data)
 
     def open(self):
-        """Open a file object to the specified URL."""
-        try:
-            if DEBUG:
-                print("loading " + self.get_full_url())
-                if self.data:
-                    print("  " + self.data)
-            return urllib.request.urlopen(self)
-        except urllib.error.HTTPError as e:
-            raise TMDBHTTPError(e)
+        """
+        Open a file object to the specified URL. Requests refused for
+        going over the rate limit are sent again once the server allows.
+        """
+        for attempt in range(self.retries + 1):
+            wait = limiter.acquire()
+            if wait:
+                if DEBUG:
+                    print("rate limiting - waited {0} seconds".format(wait))
+                cache.metrics.time("rate_limit", wait)
+            try:
+                if DEBUG:
+                    print("loading " + self.get_full_url())
+                    if self.data:
+                        print("  " + self.data)
+                response = pool.urlopen(self)
+            except urllib.error.HTTPError as e:
+                throttle(e.headers)
+                if (e.code != 429) or (attempt == self.retries):
+                    # error responses may hold a compressed TMDB status
+                    raise TMDBHTTPError(
+                        urllib.error.HTTPError(
+                            e.url,
+                            e.code,
+                            e.msg,
+                            e.headers,
+                            decode(e.fp, e.headers),
+                        )
+                    )
+                wait = retry_after(e.headers)
+                if DEBUG:
+                    print("rate limited by server - retry in {0}".format(wait))
+                cache.metrics.count("throttled")
+                limiter.pause(wait)
+                if not limiter.rate:
+                    # limiter disabled, wait here instead
+                    time.sleep(wait)
+                continue
+            throttle(response.headers)
+            fp = decode(response, response.headers)
+            if fp is response:
+                return response
+            return urllib.response.addinfourl(
+                fp, response.headers, response.geturl(), response.getcode()
+            )
 
     def read(self):
         """Return result from specified URL as a string."""
         return self.open().read()
 
-    @cache.cached(urllib.request.Request.get_full_url)
     def readJSON(self):
         """Parse result from specified URL as JSON data."""
+        data = self._readJSON()
+        # raise any error from TMDB, including those pulled from the cache
+        handle_status(data, self.get_full_url())
+        if DEBUG:
+            import pprint
+
+            pprint.PrettyPrinter().pprint(data)
+        return data
+
+    def cache_lifetime(self, data):
+        """Return how long the given response should be cached for."""
+        if data.get("status_code") in negative_status:
+            return min(self.lifetime, self.negative_lifetime)
+        return self.lifetime
+
+    @cache.cached(cache_key)
+    def _readJSON(self):
+        """
+        Parse result from specified URL as JSON data, returning rather than
+        raising errors for invalid ids and missing resources, so they may be
+        cached.
+        """
         url = self.get_full_url()
         try:
             # catch HTTP error from open()
@@ -134,18 +339,19 @@ class Request(urllib.request.Request):
                 # try to load whatever was returned
                 data = json.loads(e.response)
             except:
-                # cannot parse json, just raise existing error
-                raise e
-            else:
-                # response parsed, try to raise error from TMDB
-                handle_status(data, url)
+                if e.httperrno == 404:
+                    data = {"status_code": 34}
+                else:
+                    # cannot parse json, just raise existing error
+                    raise e
+            if data.get("status_code") in negative_status:
+                return data
+            # response parsed, try to raise error from TMDB
+            handle_status(data, url)
             # no error from TMDB, just raise existing error
             raise e
-        handle_status(data, url)
-        if DEBUG:
-            import pprint
-
-            pprint.PrettyPrinter().pprint(data)
+        if data.get("status_code") not in negative_status:
+            handle_status(data, url)
         return data
 
 
@@ -181,8 +387,17 @@ status_handlers = {
     15: TMDBError("Failed"),
     16: TMDBError("Device Denied"),
     17: TMDBError("Session Denied"),
+    25: TMDBRequestError(
+        "Request limit - Your request count is over the allowed limit."
+    ),
+    34: TMDBRequestInvalid(
+        "Resource not found - The resource you requested could not be found."
+    ),
 }
 
+# statuses returned from Request._readJSON to be cached, rather than raised
+negative_status = (6, 34)
+
 
 def handle_status(data, query):
     status = status_handlers[data.get("status_code", 1)]